@@ -0,0 +1,82 @@
+import os
+from decimal import Decimal
+
+from money import Money, Quantity
+
+# How far past its equal weight, as a share of the whole portfolio, a position may grow when spending leftover cash
+MAX_WEIGHT_DEVIATION = Decimal("0.05")
+
+# Share of the portfolio value left as cash. Holdings are valued at the ask, sells fill nearer the bid and market buys
+# at the open slip, so spending all of it would leave the buys short of funds and Schwab would reject or margin them.
+CASH_RESERVE = Decimal(os.environ.get("CASH_RESERVE", "0.0025"))
+
+
+# Micro-units in a cent
+MICROS_PER_CENT = 10_000
+
+
+def _cents_floor(amount: Money):
+    return amount.micros // MICROS_PER_CENT
+
+
+def _cents_ceiling(amount: Money):
+    return -(-amount.micros // MICROS_PER_CENT)
+
+
+def _chunks(count: int):
+    # Split a share limit into 1, 2, 4, ... so every count up to the limit is a sum of distinct chunks
+    chunk = 1
+    while count > 0:
+        size = min(chunk, count)
+        yield size
+        count -= size
+        chunk *= 2
+
+
+def allocate_remaining_amount(prices: dict[str, Money], desired_positions: dict[str, Quantity],
+                              amount_to_spend: Money, max_position_value: Money):
+    # Buys extra whole shares with leftover cash so that as little as possible is left over, without any position
+    # going above max_position_value. This is a bounded knapsack over integer cents, solved with Python integers as
+    # bitsets of reachable spend amounts, so it runs in time linear in the number of cents rather than exponentially.
+    # Prices are rounded up to the cent, so the result never spends more than amount_to_spend.
+    items = []
+    for symbol, quantity in desired_positions.items():
+        price = prices[symbol]
+        if price <= 0:
+            continue
+
+        price_cents = _cents_ceiling(price)
+        limit = (max_position_value - price * quantity) // price
+        limit = min(limit, _cents_floor(amount_to_spend) // price_cents)
+
+        for chunk in _chunks(limit):
+            items.append((symbol, chunk, chunk * price_cents))
+
+    # Nothing beyond the total of every allowed extra share can be reached, so don't carry bits for it
+    budget = min(_cents_floor(amount_to_spend), sum(cost for _, _, cost in items))
+    if budget <= 0:
+        return dict(desired_positions), amount_to_spend
+
+    mask = (1 << (budget + 1)) - 1
+
+    # Bit n of reachable is set when exactly n cents can be spent using the items seen so far
+    reachable = 1
+    history = []
+    for _, _, cost in items:
+        history.append(reachable)
+        reachable |= (reachable << cost) & mask
+
+    spent = reachable.bit_length() - 1
+
+    allocation = dict(desired_positions)
+    remaining = spent
+    for (symbol, chunk, cost), before in zip(reversed(items), reversed(history)):
+        # If the amount was already reachable before this item, the item wasn't needed to reach it
+        if not (before >> remaining) & 1:
+            allocation[symbol] += chunk
+            remaining -= cost
+
+    amount_left = amount_to_spend - sum((prices[symbol] * (allocation[symbol] - desired_positions[symbol])
+                                         for symbol in allocation), Money(0))
+
+    return allocation, amount_left
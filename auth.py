@@ -1,7 +1,6 @@
 import json
 import os
 import schwab
-import ssm
 import logging
 
 logger = logging.getLogger()
@@ -41,7 +40,8 @@ def callback_handler(event, lambda_context):
 
     token_resp = schwab.get_token(code)
 
-    ssm.put_secret("/algotrading/schwab/refreshtoken", token_resp["refresh_token"])
+    # The access token of the previous grant is replaced too, or new containers would keep using it until it expired
+    schwab.save_tokens(token_resp)
 
     # Redirect the user to the authorization URL
     response = {
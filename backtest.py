@@ -0,0 +1,233 @@
+import argparse
+import logging
+from datetime import date, datetime, timezone
+from typing import NamedTuple
+
+import numpy as np
+
+import indicators
+import strategy
+from parameters import Parameters
+from series import PriceSeries
+from strategy import FALLING_RATES_STOCKS, RISING_RATES_HEDGE, RISING_RATES_OPTIONS, RISK_ON_OPTIONS
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+SYMBOLS = ["AGG", "BIL", "TLT"] + RISK_ON_OPTIONS + RISING_RATES_OPTIONS + [RISING_RATES_HEDGE] + FALLING_RATES_STOCKS
+
+TRADING_DAYS_PER_YEAR = 252
+
+
+class BacktestResult(NamedTuple):
+    dates: np.ndarray
+    symbols: list
+    weights: np.ndarray
+    equity: np.ndarray
+    returns: np.ndarray
+    turnover: np.ndarray
+    drawdown: np.ndarray
+    stops: np.ndarray
+
+    @property
+    def total_return(self):
+        return float(self.equity[-1] / self.equity[0] - 1)
+
+    @property
+    def annualized_return(self):
+        years = len(self.returns) / TRADING_DAYS_PER_YEAR
+        return float((self.equity[-1] / self.equity[0]) ** (1 / years) - 1) if years > 0 else 0.0
+
+    @property
+    def max_drawdown(self):
+        return float(self.drawdown.min())
+
+    @property
+    def sharpe_ratio(self):
+        deviation = self.returns.std()
+        return float(self.returns.mean() / deviation * np.sqrt(TRADING_DAYS_PER_YEAR)) if deviation > 0 else 0.0
+
+    def summary(self):
+        return {
+            "start": str(self.dates[0]),
+            "end": str(self.dates[-1]),
+            "days": len(self.returns),
+            "total_return": self.total_return,
+            "annualized_return": self.annualized_return,
+            "max_drawdown": self.max_drawdown,
+            "sharpe_ratio": self.sharpe_ratio,
+            "average_daily_turnover": float(self.turnover.mean()),
+            "stops_triggered": int(self.stops.sum()),
+        }
+
+
+class Universe(NamedTuple):
+    # Every symbol's bars aligned on the dates all of them traded, plus the indicators computed on each symbol's own
+    # unaligned history (so dividend payment dates and lookbacks see exactly what the live run would have seen)
+    dates: np.ndarray
+    symbols: list
+    open: np.ndarray
+    high: np.ndarray
+    low: np.ndarray
+    close: np.ndarray
+    dividends: np.ndarray
+    series: dict
+    dividend_records: dict
+
+    def column(self, symbol):
+        return self.symbols.index(symbol)
+
+    def aligned(self, symbol, values):
+        series = self.series[symbol]
+        return values[np.searchsorted(series.dates, self.dates)]
+
+    def cumulative_return(self, symbol, days):
+        return self.aligned(symbol, indicators.rolling_cumulative_return(
+            self.series[symbol], self.dividend_records.get(symbol), days))
+
+    def relative_strength_index(self, symbol, days):
+        return self.aligned(symbol, indicators.rolling_relative_strength_index(self.series[symbol], days))
+
+
+def build_universe(series: dict[str, PriceSeries], dividend_records: dict[str, list[dict]]):
+    symbols = [symbol for symbol in SYMBOLS if symbol in series]
+    missing = set(SYMBOLS) - set(symbols)
+    if missing:
+        raise Exception(f"Missing price history for {sorted(missing)}")
+
+    dates = series[symbols[0]].dates
+    for symbol in symbols[1:]:
+        dates = np.intersect1d(dates, series[symbol].dates)
+
+    def stack(field):
+        return np.column_stack([getattr(series[symbol], field)[np.searchsorted(series[symbol].dates, dates)]
+                                for symbol in symbols])
+
+    # Cash paid per share to whoever held the symbol going into each aligned date
+    dividends = np.zeros((len(dates), len(symbols)))
+    for column, symbol in enumerate(symbols):
+        for dividend in dividend_records.get(symbol) or []:
+            index = int(np.searchsorted(dates, np.datetime64(dividend['ex_date'], "D")))
+            if index < len(dates):
+                dividends[index, column] += float(dividend['amount'])
+
+    return Universe(dates, symbols, stack("open"), stack("high"), stack("low"), stack("close"), dividends, series,
+                    dividend_records)
+
+
+def target_weights(universe: Universe, parameters: Parameters):
+    # The live strategy tree evaluated for every day at once. Row t holds the signal computed from bars up to t.
+    return strategy.target_weights(strategy.default_strategy(parameters), universe)
+
+
+def run_backtest(universe: Universe, parameters: Parameters = Parameters(), transaction_cost: float = 0.0):
+    # The live bot decides at the open using bars up to the previous close, rebalances to equal weight, then places a
+    # trailing stop on everything it holds. Day t's position is therefore held from open t to open t+1 unless the
+    # stop triggers. Daily bars don't say whether the high came before the low, so the stop is assumed to trail the
+    # day's high first, the pessimistic reading.
+    signal = target_weights(universe, parameters)
+
+    # Decide at open t with the signal from close t-1, the last day has no next open to measure against
+    weights = signal[:-2]
+    entry = universe.open[1:-1]
+    next_open = universe.open[2:]
+    high = universe.high[1:-1]
+    low = universe.low[1:-1]
+    dividends = universe.dividends[2:]
+
+    stop_price = high * (1 - parameters.trailing_stop_percentage / 100)
+    stopped = (low <= stop_price) & (weights > 0)
+
+    growth = np.where(stopped, stop_price / entry, (next_open + dividends) / entry)
+
+    held = weights.sum(axis=1)
+    portfolio_growth = (weights * growth).sum(axis=1) + (1 - held)
+
+    # Weights drift with the market until the next rebalance, turnover is what it takes to get back to target
+    with np.errstate(divide="ignore", invalid="ignore"):
+        drifted = np.where(stopped, 0.0, weights * growth) / portfolio_growth[:, None]
+    previous = np.vstack([np.zeros((1, weights.shape[1])), drifted[:-1]])
+    turnover = np.abs(weights - previous).sum(axis=1) / 2 + np.where(stopped, weights, 0).sum(axis=1)
+
+    returns = portfolio_growth - 1 - transaction_cost * turnover
+
+    equity = np.concatenate([[1.0], np.cumprod(1 + returns)])
+    drawdown = equity / np.maximum.accumulate(equity) - 1
+
+    return BacktestResult(universe.dates[1:], universe.symbols, weights, equity, returns, turnover, drawdown,
+                          stopped.any(axis=1))
+
+
+def fetch_universe(start: date):
+    # Pulls multi-year daily history straight from Schwab, only used when iterating on the strategy offline
+    from dividends import get_dividends
+    from schwab import get_price_history
+
+    start_ms = int(datetime(start.year, start.month, start.day, tzinfo=timezone.utc).timestamp() * 1000)
+    end_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+
+    histories = {symbol: get_price_history(symbol, start_date=start_ms, end_date=end_ms) for symbol in SYMBOLS}
+    series = {symbol: PriceSeries.from_candles(symbol, candles) for symbol, candles in histories.items()}
+    dividend_records = {symbol: get_dividends(symbol) for symbol in SYMBOLS}
+
+    return series, dividend_records
+
+
+def save_universe(path: str, series: dict[str, PriceSeries], dividend_records: dict[str, list[dict]]):
+    arrays = {}
+    for symbol, symbol_series in series.items():
+        for field in ("dates", "open", "high", "low", "close", "volume"):
+            arrays[f"{symbol}.{field}"] = getattr(symbol_series, field)
+
+        records = dividend_records.get(symbol) or []
+        arrays[f"{symbol}.ex_date"] = np.array([d['ex_date'] for d in records], dtype="datetime64[D]")
+        arrays[f"{symbol}.payment_date"] = np.array([d['payment_date'] for d in records], dtype="datetime64[D]")
+        arrays[f"{symbol}.amount"] = np.array([str(d['amount']) for d in records], dtype=str)
+
+    np.savez_compressed(path, **arrays)
+
+
+def load_universe(path: str):
+    from decimal import Decimal
+
+    arrays = np.load(path)
+    symbols = sorted({name.split(".")[0] for name in arrays.files})
+
+    series = {}
+    dividend_records = {}
+    for symbol in symbols:
+        series[symbol] = PriceSeries(symbol, *(arrays[f"{symbol}.{field}"]
+                                               for field in ("dates", "open", "high", "low", "close", "volume")))
+        dividend_records[symbol] = [{
+            'ex_date': ex_date.astype(date),
+            'payment_date': payment_date.astype(date),
+            'amount': Decimal(str(amount))
+        } for ex_date, payment_date, amount in zip(arrays[f"{symbol}.ex_date"], arrays[f"{symbol}.payment_date"],
+                                                   arrays[f"{symbol}.amount"])]
+
+    return series, dividend_records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backtest the strategy tree over daily history")
+    parser.add_argument("data", help="universe file written by --fetch")
+    parser.add_argument("--fetch", metavar="START_DATE", help="download history from Schwab starting at this date")
+    parser.add_argument("--transaction-cost", type=float, default=0.0, help="cost per unit of turnover")
+    for field, default in Parameters._field_defaults.items():
+        parser.add_argument(f"--{field.replace('_', '-')}", type=type(default), default=default)
+    args = parser.parse_args()
+
+    if args.fetch:
+        save_universe(args.data, *fetch_universe(date.fromisoformat(args.fetch)))
+
+    universe = build_universe(*load_universe(args.data))
+    parameters = Parameters(**{field: getattr(args, field) for field in Parameters._fields})
+
+    result = run_backtest(universe, parameters, args.transaction_cost)
+
+    for key, value in result.summary().items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Stand-in for the Schwab market data, accounts and orders endpoints and for Polygon dividends. Orders fill after a
+# configurable delay and update the account they belong to, so a full rebalance can run against it end to end.
+
+HISTORY_DAYS = 400
+TERMINAL_STATUSES = {"FILLED", "REJECTED", "CANCELED", "EXPIRED", "REPLACED"}
+
+
+def _closes(symbol):
+    generator = random.Random(zlib.crc32(symbol.encode()))
+    price = generator.uniform(20, 200)
+    closes = []
+    for _ in range(HISTORY_DAYS):
+        price *= 1 + generator.gauss(0.0003, 0.02)
+        closes.append(round(price, 2))
+    return closes
+
+
+class MockState:
+    def __init__(self, fill_delay: float = 0.5, starting_cash: float = 100000.0):
+        self.fill_delay = fill_delay
+        self.starting_cash = starting_cash
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.accounts = {}
+        self.orders = {}
+        self.next_order_id = 1
+        self._history = {}
+
+        today = datetime.now(timezone.utc).replace(hour=5, minute=0, second=0, microsecond=0)
+        self.bar_times = []
+        day = today - timedelta(days=1)
+        while len(self.bar_times) < HISTORY_DAYS:
+            if day.weekday() < 5:
+                self.bar_times.append(int(day.timestamp() * 1000))
+            day -= timedelta(days=1)
+        self.bar_times.reverse()
+
+    def history(self, symbol):
+        if symbol not in self._history:
+            self._history[symbol] = _closes(symbol)
+        return self._history[symbol]
+
+    def price(self, symbol):
+        return self.history(symbol)[-1]
+
+    def account(self, account_hash):
+        if account_hash not in self.accounts:
+            self.accounts[account_hash] = {"cash": self.starting_cash, "positions": {}, "roundTrips": 0}
+        return self.accounts[account_hash]
+
+    def order_view(self, account_hash, order):
+        # Fill market orders once their delay has passed, updating the account as Schwab would
+        if order["status"] == "WORKING" and order["orderType"] == "MARKET" and time.time() >= order["fillAt"]:
+            account = self.account(account_hash)
+            price = self.price(order["symbol"])
+            quantity = order["quantity"]
+            if order["instruction"] == "SELL":
+                account["positions"][order["symbol"]] = account["positions"].get(order["symbol"], 0) - quantity
+                account["cash"] += price * quantity
+            else:
+                account["positions"][order["symbol"]] = account["positions"].get(order["symbol"], 0) + quantity
+                account["cash"] -= price * quantity
+            order["status"] = "FILLED"
+            order["filledQuantity"] = quantity
+            order["orderActivityCollection"] = [{"executionLegs": [{"quantity": quantity, "price": price}]}]
+
+        return {
+            "orderId": order["orderId"],
+            "status": order["status"],
+            "enteredTime": order["enteredTime"],
+            "cancelable": order["status"] not in TERMINAL_STATUSES,
+            "filledQuantity": order.get("filledQuantity", 0),
+            "orderActivityCollection": order.get("orderActivityCollection", []),
+            "orderLegCollection": [{"instruction": order["instruction"], "instrument": {"symbol": order["symbol"]}}],
+        }
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self) -> MockState:
+        return self.server.state
+
+    def _respond(self, status, body=None, headers=None):
+        payload = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _delay(self):
+        self.server.latency and time.sleep(self.server.latency + random.uniform(0, self.server.jitter))
+
+    def _route(self, method):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+
+        self._delay()
+
+        for pattern, route_method, name, handler in ROUTES:
+            match = re.fullmatch(pattern, url.path)
+            if match and method == route_method:
+                with self.state.lock:
+                    self.state.requests[name] += 1
+                    return handler(self, query, body, *match.groups())
+
+        self._respond(404, {"error": f"No route for {method} {url.path}"})
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_POST(self):
+        self._route("POST")
+
+    def do_DELETE(self):
+        self._route("DELETE")
+
+    def token(self, query, body):
+        self._respond(200, {"access_token": "mock-access", "refresh_token": "mock-refresh", "expires_in": 1800})
+
+    def price_history(self, query, body):
+        symbol = query["symbol"]
+        start = int(query.get("startDate", 0))
+        end = int(query.get("endDate", 2 ** 62))
+        candles = []
+        for timestamp, close in zip(self.state.bar_times, self.state.history(symbol)):
+            if start <= timestamp <= end:
+                candles.append({"datetime": timestamp, "open": close, "high": round(close * 1.01, 2),
+                                "low": round(close * 0.99, 2), "close": close, "volume": 100000})
+        self._respond(200, {"symbol": symbol, "candles": candles})
+
+    def quotes(self, query, body):
+        quotes = {}
+        for symbol in query.get("symbols", "").split(","):
+            if symbol:
+                price = self.state.price(symbol)
+                quotes[symbol] = {"realtime": True, "quote": {"askPrice": price, "bidPrice": round(price - 0.01, 2),
+                                                             "lastPrice": price}}
+        self._respond(200, quotes)
+
+    def user_preference(self, query, body):
+        self._respond(200, {"streamerInfo": [{
+            "streamerSocketUrl": self.server.streamer_url,
+            "schwabClientCustomerId": "mock-customer",
+            "schwabClientCorrelId": "mock-correlation",
+            "schwabClientChannel": "N9",
+            "schwabClientFunctionId": "APIAPP",
+        }]})
+
+    def account(self, query, body, account_hash):
+        account = self.state.account(account_hash)
+        self._respond(200, {"securitiesAccount": {
+            "currentBalances": {"availableFunds": round(account["cash"], 2)},
+            "roundTrips": account["roundTrips"],
+            "positions": [{"instrument": {"symbol": symbol}, "longQuantity": quantity}
+                          for symbol, quantity in account["positions"].items() if quantity > 0],
+        }})
+
+    def place_order(self, query, body, account_hash):
+        request = json.loads(body)
+        leg = request["orderLegCollection"][0]
+        order_id = self.state.next_order_id
+        self.state.next_order_id += 1
+        self.state.orders.setdefault(account_hash, {})[order_id] = {
+            "orderId": order_id,
+            "orderType": request["orderType"],
+            "symbol": leg["instrument"]["symbol"],
+            "instruction": leg["instruction"],
+            "quantity": leg["quantity"],
+            "status": "WORKING",
+            "enteredTime": datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S+0000'),
+            "fillAt": time.time() + self.state.fill_delay,
+        }
+        self._respond(201, headers={"Location": f"/trader/v1/accounts/{account_hash}/orders/{order_id}"})
+
+    def list_orders(self, query, body, account_hash):
+        orders = [self.state.order_view(account_hash, order)
+                  for order in self.state.orders.get(account_hash, {}).values()]
+        if "status" in query:
+            orders = [order for order in orders if order["status"] == query["status"]]
+        self._respond(200, orders)
+
+    def get_order(self, query, body, account_hash, order_id):
+        order = self.state.orders.get(account_hash, {}).get(int(order_id))
+        if order is None:
+            return self._respond(404, {"error": "Order not found"})
+        self._respond(200, self.state.order_view(account_hash, order))
+
+    def cancel_order(self, query, body, account_hash, order_id):
+        order = self.state.orders.get(account_hash, {}).get(int(order_id))
+        if order is None or order["status"] in TERMINAL_STATUSES:
+            return self._respond(400, {"error": "Order not cancelable"})
+        order["status"] = "CANCELED"
+        self._respond(200)
+
+    def dividends(self, query, body):
+        ticker = query.get("ticker", "")
+        results = []
+        # A monthly distribution for the bond and bill funds, nothing for the rest
+        if ticker in ("AGG", "BIL", "TLT"):
+            for months_ago in range(12):
+                ex_date = datetime.now(timezone.utc).date().replace(day=1) - timedelta(days=30 * months_ago)
+                results.append({"ticker": ticker, "ex_dividend_date": ex_date.isoformat(),
+                                "pay_date": (ex_date + timedelta(days=4)).isoformat(), "cash_amount": 0.3})
+        if "ex_dividend_date.gt" in query:
+            results = [result for result in results if result["ex_dividend_date"] > query["ex_dividend_date.gt"]]
+        self._respond(200, {"status": "OK", "results": results})
+
+
+ROUTES = [
+    (r"/v1/oauth/token", "POST", "oauth/token", MockHandler.token),
+    (r"/marketdata/v1/pricehistory", "GET", "pricehistory", MockHandler.price_history),
+    (r"/marketdata/v1/quotes", "GET", "quotes", MockHandler.quotes),
+    (r"/trader/v1/userPreference", "GET", "userPreference", MockHandler.user_preference),
+    (r"/trader/v1/accounts/([^/]+)", "GET", "account", MockHandler.account),
+    (r"/trader/v1/accounts/([^/]+)/orders", "POST", "place_order", MockHandler.place_order),
+    (r"/trader/v1/accounts/([^/]+)/orders", "GET", "get_orders", MockHandler.list_orders),
+    (r"/trader/v1/accounts/([^/]+)/orders/(\d+)", "GET", "get_order", MockHandler.get_order),
+    (r"/trader/v1/accounts/([^/]+)/orders/(\d+)", "DELETE", "cancel_order", MockHandler.cancel_order),
+    (r"/v3/reference/dividends", "GET", "polygon/dividends", MockHandler.dividends),
+]
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0.02, jitter: float = 0.01, fill_delay: float = 0.5, port: int = 0):
+        super().__init__(("127.0.0.1", port), MockHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.state = MockState(fill_delay)
+        # Where userPreference sends the streamer client, see mock_streamer
+        self.streamer_url = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def reset(self):
+        self.state = MockState(self.state.fill_delay)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
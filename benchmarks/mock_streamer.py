@@ -0,0 +1,111 @@
+import asyncio
+import json
+import threading
+import time
+
+import websockets
+
+# Stand-in for the Schwab streamer websocket: answers LOGIN, SUBS and ADD for LEVELONE_EQUITIES and pushes whatever
+# prices it is told to. Runs its own event loop on a background thread so synchronous code can drive it.
+
+
+class MockStreamer:
+    def __init__(self, prices: dict = None, access_token: str = "mock-access"):
+        self.access_token = access_token
+        self.prices = dict(prices or {})
+        self.logins = 0
+        self.subscriptions = []
+        self._clients = {}
+        self._loop = None
+        self._server = None
+        self._ready = threading.Event()
+        self._thread = None
+        self.port = None
+
+    @property
+    def url(self):
+        return f"ws://127.0.0.1:{self.port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=lambda: asyncio.run(self._serve()), daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._server.close)
+        self._thread.join()
+
+    def push(self, symbol: str, **fields):
+        # e.g. push("SOXL", ask=31.2) sends only the ask, like Schwab sends only what changed
+        self.prices.setdefault(symbol, {}).update(fields)
+        asyncio.run_coroutine_threadsafe(self._push(symbol, fields), self._loop).result()
+
+    def drop_connections(self):
+        # Closes every client socket without warning, the client has to reconnect and subscribe again
+        asyncio.run_coroutine_threadsafe(self._drop(), self._loop).result()
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._server = await websockets.serve(self._handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        await self._server.wait_closed()
+
+    async def _drop(self):
+        for websocket in list(self._clients):
+            websocket.transport.abort()
+
+    async def _push(self, symbol, fields):
+        content = {"key": symbol, **_numbered(fields)}
+        for websocket, symbols in list(self._clients.items()):
+            if symbol in symbols:
+                await websocket.send(json.dumps(_data([content])))
+
+    async def _handle(self, websocket):
+        self._clients[websocket] = set()
+        try:
+            async for message in websocket:
+                for request in json.loads(message)["requests"]:
+                    await self._request(websocket, request)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self._clients.pop(websocket, None)
+
+    async def _request(self, websocket, request):
+        command = request["command"]
+        code, msg = 0, "ok"
+
+        if command == "LOGIN":
+            if request["parameters"]["Authorization"] != self.access_token:
+                code, msg = 3, "Login denied"
+            else:
+                self.logins += 1
+        elif command in ("SUBS", "ADD"):
+            symbols = request["parameters"]["keys"].split(",")
+            self.subscriptions.append((command, symbols))
+            if command == "SUBS":
+                self._clients[websocket] = set()
+            self._clients[websocket].update(symbols)
+
+        await websocket.send(json.dumps({"response": [{
+            "service": request["service"], "requestid": request["requestid"], "command": command,
+            "timestamp": int(time.time() * 1000), "content": {"code": code, "msg": msg},
+        }]}))
+
+        # A subscription starts with every field of every symbol
+        if command in ("SUBS", "ADD") and code == 0:
+            content = [{"key": symbol, **_numbered(self.prices[symbol])} for symbol in symbols if symbol in self.prices]
+            if content:
+                await websocket.send(json.dumps(_data(content)))
+
+
+def _numbered(fields):
+    numbers = {"bid": "1", "ask": "2", "last": "3"}
+    return {numbers[name]: value for name, value in fields.items()}
+
+
+def _data(content):
+    return {"data": [{"service": "LEVELONE_EQUITIES", "timestamp": int(time.time() * 1000), "command": "SUBS",
+                      "content": content}]}
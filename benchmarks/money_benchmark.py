@@ -0,0 +1,121 @@
+import argparse
+import random
+import timeit
+from decimal import Decimal
+
+from money import Money, Quantity
+from portfolio import Portfolio
+
+# Compares the fixed-point Money/Quantity model with the Decimal(str(float)) arithmetic it replaced, over the parts
+# of a rebalance that run once per account: reading the account, valuing it at the quoted ask and diffing it against
+# the target. The Decimal side does the conversions process_portfolio and get_value_of_portfolio used to do.
+# Run from the repository root: python -m benchmarks.money_benchmark
+
+SYMBOLS = ["SOXL", "TQQQ", "UPRO", "TECL", "UUP", "QID", "TBF", "UGL", "TMF", "BTAL", "XLP"]
+
+
+def _accounts(count, positions, generator):
+    accounts = []
+    for _ in range(count):
+        accounts.append({"securitiesAccount": {
+            "currentBalances": {"availableFunds": round(generator.uniform(0, 200000), 2)},
+            "positions": [{"instrument": {"symbol": symbol}, "longQuantity": float(generator.randint(1, 800))}
+                          for symbol in generator.sample(SYMBOLS, positions)],
+        }})
+    return accounts
+
+
+def _decimal_read(account):
+    securities_account = account["securitiesAccount"]
+    cash = Decimal(str(securities_account["currentBalances"]["availableFunds"]))
+    positions = {position["instrument"]["symbol"]: Decimal(str(position["longQuantity"]))
+                 for position in securities_account["positions"]}
+    return cash, positions
+
+
+def _decimal_value(cash, positions, quotes):
+    total = Decimal(str(cash))
+    for symbol, quantity in positions.items():
+        total += Decimal(str(quotes[symbol])) * Decimal(str(quantity))
+    return total
+
+
+def _fixed_value(portfolio, quotes):
+    return portfolio.value({symbol: Money.of(quotes[symbol]) for symbol in portfolio.positions})
+
+
+def _decimal_diff(current, desired):
+    sell, buy = {}, {}
+    for symbol in current.keys() | desired.keys():
+        change = desired.get(symbol, Decimal(0)) - current.get(symbol, Decimal(0))
+        if change > 0:
+            buy[symbol] = change
+        elif change < 0:
+            sell[symbol] = -change
+    return sell, buy
+
+
+def _fixed_diff(current, desired):
+    sell, buy = {}, {}
+    for symbol in current.keys() | desired.keys():
+        change = (desired[symbol].micros if symbol in desired else 0) - \
+                 (current[symbol].micros if symbol in current else 0)
+        if change > 0:
+            buy[symbol] = Quantity(change)
+        elif change < 0:
+            sell[symbol] = Quantity(-change)
+    return sell, buy
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time Decimal against fixed-point money over many accounts")
+    parser.add_argument("--accounts", type=int, default=5000)
+    parser.add_argument("--positions", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    generator = random.Random(1)
+    accounts = _accounts(args.accounts, args.positions, generator)
+    quotes = {symbol: round(generator.uniform(3, 400), 2) for symbol in SYMBOLS}
+    targets = {symbol: generator.randint(1, 800) for symbol in generator.sample(SYMBOLS, 2)}
+
+    # Targets are computed once per run, the same for every account
+    decimal_targets = {symbol: Decimal(quantity) for symbol, quantity in targets.items()}
+    fixed_targets = {symbol: Quantity.of(quantity) for symbol, quantity in targets.items()}
+
+    decimal_read = [_decimal_read(account) for account in accounts]
+    fixed_read = []
+    for account in accounts:
+        portfolio = Portfolio("benchmark")
+        portfolio.update_from_account(account)
+        fixed_read.append(portfolio)
+
+    def time(function):
+        return min(timeit.repeat(function, number=1, repeat=args.repeat))
+
+    def read_fixed():
+        for account in accounts:
+            Portfolio("benchmark").update_from_account(account)
+
+    rows = [
+        ("read account", time(lambda: [_decimal_read(account) for account in accounts]), time(read_fixed)),
+        ("value", time(lambda: [_decimal_value(cash, positions, quotes) for cash, positions in decimal_read]),
+         time(lambda: [_fixed_value(portfolio, quotes) for portfolio in fixed_read])),
+        ("diff", time(lambda: [_decimal_diff(positions, decimal_targets) for _, positions in decimal_read]),
+         time(lambda: [_fixed_diff(portfolio.quantities(), fixed_targets) for portfolio in fixed_read])),
+    ]
+
+    print(f"{args.accounts} accounts with {args.positions} positions")
+    print(f"  {'':<14} {'Decimal':>10} {'fixed':>10}")
+    for name, decimal_seconds, fixed_seconds in rows:
+        print(f"  {name:<14} {decimal_seconds * 1000:8.1f}ms {fixed_seconds * 1000:8.1f}ms "
+              f"{decimal_seconds / fixed_seconds:5.2f}x")
+
+    # Both sides must agree to the last digit
+    for (cash, positions), portfolio in zip(decimal_read, fixed_read):
+        if _decimal_value(cash, positions, quotes) != _fixed_value(portfolio, quotes).to_decimal():
+            raise Exception("Fixed-point valuation differs from Decimal")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import argparse
+import functools
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from benchmarks.mock_server import MockServer
+
+# Drives main.run and main.cancel_orders against the local mock server with a growing number of synthetic
+# portfolios. Run from the repository root: python -m benchmarks.run_benchmark
+
+PHASES = {
+    "strategy": "create_strategies",
+    "load_portfolios": "get_all_portfolios",
+    "valuation": "get_value_of_portfolio",
+    "cancel": "cancel_outstanding_orders",
+    "allocation": "determine_desired_positions",
+    "order_submission": "submit_orders",
+    "fill_tracking": "track_orders",
+    "store": "buffer_portfolio",
+    "flush": "flush_portfolios",
+    "portfolio": "run_for_portfolio",
+}
+
+
+class PhaseTimer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+
+    def wrap(self, phase, function, consume=False):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+                # Generators only do their work when consumed
+                return list(result) if consume else result
+            finally:
+                with self._lock:
+                    self.samples[phase].append(time.perf_counter() - started)
+        return timed
+
+    def report(self):
+        report = {}
+        for phase, samples in self.samples.items():
+            ordered = sorted(samples)
+            report[phase] = {
+                "count": len(samples),
+                "total": sum(samples),
+                "mean": statistics.mean(samples),
+                "p50": ordered[len(ordered) // 2],
+                "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                "max": ordered[-1],
+            }
+        return report
+
+
+def _prepare_environment(server_url, cache_dir):
+    # Must run before any of the bot's modules are imported, they read these at import time
+    os.environ["SCHWAB_BASE_URL"] = server_url
+    os.environ["POLYGON_BASE_URL"] = server_url
+    os.environ["CANDLE_CACHE_DIR"] = os.path.join(cache_dir, "candles")
+    os.environ["DIVIDEND_CACHE_PATH"] = os.path.join(cache_dir, "dividends.json")
+    os.environ["INDICATOR_STATE_PATH"] = os.path.join(cache_dir, "indicators.json")
+    os.environ.setdefault("PORTFOLIO_TABLE_NAME", "benchmark-portfolios")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-1")
+    os.environ.setdefault("API_URL", server_url)
+    # The mock server doesn't throttle, set SCHWAB_RATE_LIMIT to measure the bot under Schwab's real budget
+    os.environ.setdefault("SCHWAB_RATE_LIMIT", "1000000")
+
+    # SSM stand-in, patched before schwab and dividends bind get_secret and put_secret
+    import ssm
+    secrets = {"/algotrading/schwab/refreshtoken": "mock-refresh"}
+    ssm.get_secret = lambda name: secrets.get(name, "mock-secret")
+    ssm.put_secret = lambda name, value: secrets.__setitem__(name, value)
+
+
+def _install_portfolio_table(main, portfolio_count):
+    # DynamoDB stand-in
+    table = {f"account-{i:05d}": {"accountHash": f"account-{i:05d}"} for i in range(portfolio_count)}
+
+    def get_all_portfolios():
+        return [dict(item) for item in table.values()]
+
+    def buffer_portfolio(portfolio):
+        table[portfolio["accountHash"]] = portfolio
+
+    def flush_portfolios():
+        pass
+
+    main.get_all_portfolios = get_all_portfolios
+    main.buffer_portfolio = buffer_portfolio
+    main.flush_portfolios = flush_portfolios
+
+
+def _install_timers(main, timer):
+    for phase, name in PHASES.items():
+        setattr(main, name, timer.wrap(phase, getattr(main, name), consume=name == "track_orders"))
+
+
+def run_scenario(main, server, cache_dir, portfolio_count):
+    server.reset()
+
+    # Every scenario starts from cold market data caches
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.makedirs(cache_dir)
+    import dividends
+    dividends.store = dividends.DividendStore(dividends.DIVIDEND_CACHE_PATH)
+    import indicator_state
+    indicator_state.store = indicator_state.IndicatorStateStore(indicator_state.INDICATOR_STATE_PATH)
+    main.quote_service.clear()
+
+    originals = {name: getattr(main, name) for name in set(PHASES.values())}
+    results = {}
+    try:
+        _install_portfolio_table(main, portfolio_count)
+        unwrapped = {name: getattr(main, name) for name in PHASES.values()}
+
+        for job in ("run", "cancel_orders"):
+            timer = PhaseTimer()
+            _install_timers(main, timer)
+            server.state.requests.clear()
+
+            started = time.perf_counter()
+            error = None
+            try:
+                getattr(main, job)()
+            except Exception as exc:
+                error = repr(exc)
+            wall_time = time.perf_counter() - started
+
+            results[job] = {
+                "wall_time": wall_time,
+                "error": error,
+                "requests": dict(server.state.requests),
+                "total_requests": sum(server.state.requests.values()),
+                "phases": timer.report(),
+            }
+
+            for name, function in unwrapped.items():
+                setattr(main, name, function)
+    finally:
+        for name, function in originals.items():
+            setattr(main, name, function)
+
+    return results
+
+
+def print_report(portfolio_count, results):
+    for job, result in results.items():
+        print(f"\n{job} with {portfolio_count} portfolio(s): {result['wall_time']:.2f}s, "
+              f"{result['total_requests']} requests" + (f", ERROR {result['error']}" if result["error"] else ""))
+        for endpoint, count in sorted(result["requests"].items()):
+            print(f"  {endpoint:<20} {count:>8}")
+        for phase, stats in result["phases"].items():
+            print(f"  {phase:<20} n={stats['count']:<6} mean={stats['mean'] * 1000:8.1f}ms "
+                  f"p95={stats['p95'] * 1000:8.1f}ms max={stats['max'] * 1000:8.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark main.run and main.cancel_orders against a mock Schwab")
+    parser.add_argument("--portfolios", default="1,10,100,1000", help="comma separated portfolio counts")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.01, help="extra random seconds added to every response")
+    parser.add_argument("--fill-delay", type=float, default=0.5, help="seconds before a market order fills")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    args = parser.parse_args()
+
+    server = MockServer(args.latency, args.jitter, args.fill_delay).start()
+    cache_dir = tempfile.mkdtemp(prefix="algotrading-benchmark-")
+    all_results = {}
+
+    try:
+        _prepare_environment(server.url, cache_dir)
+        import main as bot
+
+        for portfolio_count in (int(count) for count in args.portfolios.split(",")):
+            results = run_scenario(bot, server, cache_dir, portfolio_count)
+            print_report(portfolio_count, results)
+            all_results[portfolio_count] = results
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(all_results, f, indent=2)
+    finally:
+        server.stop()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    failed = any(result["error"] for results in all_results.values() for result in results.values())
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
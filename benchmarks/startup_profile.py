@@ -0,0 +1,165 @@
+import argparse
+import importlib
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+# Breaks a cold start down into the time spent importing each module and the time spent building each lazily created
+# client. Every measurement runs in a fresh interpreter so nothing is already cached. Run from the repository root:
+# python -m benchmarks.startup_profile
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_TIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def _environment():
+    environment = dict(os.environ)
+    environment.setdefault("PORTFOLIO_TABLE_NAME", "startup-profile")
+    environment.setdefault("AWS_DEFAULT_REGION", "us-west-1")
+    return environment
+
+
+def _child(entry, initialize):
+    # Runs inside the profiled interpreter. Import timings go to stderr through -X importtime, the rest is printed
+    # as JSON on stdout.
+    started = time.perf_counter()
+    __import__(entry)
+    imported = time.perf_counter() - started
+
+    import ssm
+    from lazy import Lazy
+
+    # Building the Polygon client needs its key, which must not come from the real SSM
+    get_secret = ssm.get_secret
+    for module in list(sys.modules.values()):
+        if getattr(module, "get_secret", None) is get_secret:
+            module.get_secret = lambda name: "startup-profile"
+
+    inits = {}
+    for name in initialize:
+        module_name, attribute = name.rsplit(".", 1)
+        lazy = getattr(importlib.import_module(module_name), attribute, None)
+        if not isinstance(lazy, Lazy):
+            raise Exception(f"{name} is not a lazily created value")
+
+        started = time.perf_counter()
+        lazy.get()
+        inits[name] = time.perf_counter() - started
+
+    # Whatever the import left lazy and nothing above asked for
+    pending = sorted(f"{module.__name__}.{attribute}" for module in list(sys.modules.values())
+                     if getattr(module, "__file__", None) and os.path.dirname(module.__file__) == REPOSITORY
+                     for attribute, value in vars(module).items() if isinstance(value, Lazy) and not value.created)
+
+    print(json.dumps({"import": imported, "inits": inits, "pending": pending}))
+
+
+def _parse_import_times(stderr):
+    # -X importtime prints each module after its own imports, indented by nesting depth. Returns
+    # (name, own seconds, cumulative seconds, name of the module that imported it) in import order.
+    lines = []
+    for line in stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match:
+            own, cumulative, indent, name = match.groups()
+            lines.append((name, int(own) / 1e6, int(cumulative) / 1e6, len(indent) // 2))
+
+    # A module's parent is the first module printed after it at a shallower depth
+    modules = []
+    stack = []
+    for name, own, cumulative, depth in reversed(lines):
+        while stack and stack[-1][0] >= depth:
+            stack.pop()
+        modules.append((name, own, cumulative, stack[-1][1] if stack else None))
+        stack.append((depth, name))
+
+    modules.reverse()
+    return modules
+
+
+def _is_local(name):
+    return os.path.exists(os.path.join(REPOSITORY, f"{name.split('.')[0]}.py"))
+
+
+def profile(entry, initialize):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "benchmarks.startup_profile", "--child", entry,
+         "--initialize", ",".join(initialize)],
+        cwd=REPOSITORY, env=_environment(), capture_output=True, text=True)
+    if result.returncode != 0:
+        raise Exception(f"Profiling {entry} failed:\n{result.stderr[-2000:]}")
+
+    child = json.loads(result.stdout.strip().splitlines()[-1])
+    modules = _parse_import_times(result.stderr)
+
+    # The bot's own modules, and whatever they import from outside the repository charged to its top level package.
+    # Anything the profiler imported for itself before the entry module is not counted.
+    local = {}
+    packages = defaultdict(float)
+    for name, own, cumulative, parent in modules:
+        if _is_local(name):
+            local[name] = {"own": own, "cumulative": cumulative}
+        elif parent is not None and _is_local(parent):
+            packages[name.split(".")[0]] += cumulative
+
+    return {
+        "entry": entry,
+        "import": child["import"],
+        "modules": local,
+        "packages": dict(packages),
+        "inits": child["inits"],
+        "pending": child["pending"],
+    }
+
+
+def print_report(report, limit):
+    print(f"\nimport {report['entry']}: {report['import'] * 1000:.1f}ms")
+
+    print("  bot modules (own / cumulative)")
+    for name, times in sorted(report["modules"].items(), key=lambda item: item[1]["cumulative"], reverse=True):
+        print(f"    {name:<28} {times['own'] * 1000:8.1f}ms {times['cumulative'] * 1000:8.1f}ms")
+
+    print("  third party packages (cumulative)")
+    for name, seconds in sorted(report["packages"].items(), key=lambda item: item[1], reverse=True)[:limit]:
+        print(f"    {name:<28} {seconds * 1000:8.1f}ms")
+
+    if report["inits"]:
+        print("  first use")
+        for name, seconds in report["inits"].items():
+            print(f"    {name:<28} {seconds * 1000:8.1f}ms")
+
+    if report["pending"]:
+        print(f"  still lazy: {', '.join(report['pending'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile import and client initialization time of a cold start")
+    parser.add_argument("--entry", default="main", help="module the Lambda handler lives in")
+    parser.add_argument("--initialize", default="ssm.ssm_client,dynamodb.dynamodb,dividends.polygon_client",
+                        help="comma separated lazy values to build after the import, as module.attribute")
+    parser.add_argument("--limit", type=int, default=15, help="third party packages to list")
+    parser.add_argument("--child", metavar="ENTRY", help=argparse.SUPPRESS)
+    parser.add_argument("--json", metavar="PATH", help="also write the report as JSON")
+    args = parser.parse_args()
+
+    initialize = [name for name in args.initialize.split(",") if name]
+
+    if args.child:
+        _child(args.child, initialize)
+        return
+
+    report = profile(args.entry, initialize)
+    print_report(report, args.limit)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
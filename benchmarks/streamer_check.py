@@ -0,0 +1,109 @@
+import argparse
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+from benchmarks.mock_server import MockServer
+from benchmarks.mock_streamer import MockStreamer
+from benchmarks.run_benchmark import _prepare_environment
+
+# Runs streamer.QuoteStreamer against the local websocket stand-in: login, subscription, partial updates, a dropped
+# connection with resubscription, and quote_service reading pushed quotes without a request. Also compares how long
+# a pushed price takes to show up with a quotes request round trip.
+# Run from the repository root: python -m benchmarks.streamer_check
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return
+        time.sleep(0.001)
+    raise Exception("Timed out waiting for the streamer")
+
+
+def _check(condition, message):
+    if not condition:
+        raise Exception(message)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the quote streamer against a local websocket stand-in")
+    parser.add_argument("--updates", type=int, default=200, help="pushed updates to time")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every REST response")
+    args = parser.parse_args()
+
+    server = MockServer(args.latency, 0.0).start()
+    mock = MockStreamer({
+        "SOXL": {"bid": 30.0, "ask": 30.02, "last": 30.01},
+        "TQQQ": {"bid": 60.0, "ask": 60.05, "last": 60.03},
+    }).start()
+    server.streamer_url = mock.url
+    cache_dir = tempfile.mkdtemp(prefix="algotrading-streamer-")
+
+    try:
+        os.environ.setdefault("STREAMER_RECONNECT_BACKOFF", "0.05")
+        _prepare_environment(server.url, cache_dir)
+        import schwab
+        import streamer
+        from money import Money
+        from quotes import quote_service
+
+        client = streamer.QuoteStreamer().start(["SOXL", "TQQQ"])
+        _check(client.wait_connected(5), "Streamer never connected")
+        _wait_for(lambda: client.quote("TQQQ") is not None)
+        _check(client.quote("SOXL").ask == Money.of(30.02), "Initial quote differs from what was pushed")
+
+        # Only the ask changes, bid and last carry over
+        mock.push("SOXL", ask=30.5)
+        _wait_for(lambda: client.quote("SOXL").ask == Money.of(30.5))
+        _check(client.quote("SOXL").bid == Money.of(30.0), "Partial update lost a field")
+
+        # Pushed quotes are served by the quote service without a request
+        quote_service.streamer = client
+        requests_before = server.state.requests["quotes"]
+        _check(quote_service.get("SOXL").ask == Money.of(30.5), "Quote service didn't serve the streamed quote")
+        _check(server.state.requests["quotes"] == requests_before, "Quote service requested a streamed symbol")
+
+        push_latencies = []
+        for i in range(args.updates):
+            ask = Money.of(31 + i / 100)
+            started = time.perf_counter()
+            mock.push("TQQQ", ask=31 + i / 100)
+            _wait_for(lambda: client.quote("TQQQ").ask == ask)
+            push_latencies.append(time.perf_counter() - started)
+
+        request_latencies = []
+        for _ in range(min(args.updates, 50)):
+            started = time.perf_counter()
+            schwab.get_current_quotes(["TQQQ"])
+            request_latencies.append(time.perf_counter() - started)
+
+        # A dropped connection logs in and subscribes to everything again
+        mock.drop_connections()
+        _wait_for(lambda: mock.logins == 2 and client.quote("TQQQ") is not None)
+        _check(mock.subscriptions[-1] == ("SUBS", ["SOXL", "TQQQ"]), "Reconnect didn't resubscribe")
+
+        mock.prices["UPRO"] = {"bid": 70.0, "ask": 70.1, "last": 70.05}
+        client.subscribe(["UPRO"])
+        _wait_for(lambda: client.quote("UPRO") is not None)
+        _check(mock.subscriptions[-1] == ("ADD", ["UPRO"]), "New symbol wasn't added to the subscription")
+
+        quote_service.streamer = None
+        client.stop()
+        _check(client.quote("SOXL") is None, "Stopped streamer still serves quotes")
+    finally:
+        mock.stop()
+        server.stop()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    print(f"Logins: {mock.logins}, subscriptions: {mock.subscriptions}")
+    print(f"Pushed update visible after {statistics.median(push_latencies) * 1000:.2f}ms median, "
+          f"{max(push_latencies) * 1000:.2f}ms max over {len(push_latencies)} updates")
+    print(f"Quotes request round trip {statistics.median(request_latencies) * 1000:.2f}ms median")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+from dateutil.relativedelta import relativedelta
+
+import numpy as np
+
+import storage
+from schwab import get_price_history
+from series import PriceSeries
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+# Working copy of the candle files, backed by storage.STATE_BUCKET when it is set
+CANDLE_CACHE_DIR = os.environ.get("CANDLE_CACHE_DIR", "/tmp/algotrading-candles")
+
+# One fixed size record per daily bar, appended to the symbol's file as new bars arrive
+CANDLE_DTYPE = np.dtype([
+    ("datetime", "<i8"),
+    ("open", "<f8"),
+    ("high", "<f8"),
+    ("low", "<f8"),
+    ("close", "<f8"),
+    ("volume", "<i8"),
+])
+
+# Longest run of calendar days between two bars before we assume bars are missing (a Monday holiday gives 4)
+MAX_GAP_DAYS = 5
+
+# Relative difference allowed between a stored close and the same bar fetched again
+CLOSE_TOLERANCE = 1e-6
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+class CandleCacheError(Exception):
+    pass
+
+
+def _lock_for(symbol):
+    with _locks_lock:
+        return _locks.setdefault(symbol, threading.Lock())
+
+
+def _path_for(symbol):
+    return os.path.join(CANDLE_CACHE_DIR, f"{symbol}.bin")
+
+
+def _key_for(symbol):
+    return f"candles/{symbol}.bin"
+
+
+def _to_records(candles):
+    records = np.empty(len(candles), dtype=CANDLE_DTYPE)
+    for i, candle in enumerate(candles):
+        records[i] = (candle["datetime"], candle["open"], candle["high"], candle["low"], candle["close"],
+                      candle["volume"])
+    records.sort(order="datetime")
+    return records
+
+
+def _load(symbol):
+    path = _path_for(symbol)
+
+    # A cold container starts from the bucket's copy instead of a full year of candles
+    try:
+        restored = storage.restore(path, _key_for(symbol))
+    except storage.STORAGE_ERRORS as exc:
+        # Treated as a miss, the full history is fetched from Schwab instead
+        logger.error(f"Failed to restore candles for {symbol}: {exc}")
+        restored = False
+
+    if not restored:
+        return np.empty(0, dtype=CANDLE_DTYPE)
+
+    if os.path.getsize(path) % CANDLE_DTYPE.itemsize != 0:
+        raise CandleCacheError(f"{path} holds a partial record")
+
+    return np.fromfile(path, dtype=CANDLE_DTYPE)
+
+
+def _write(symbol, records, offset=0):
+    # Truncate at 'offset' records and append, everything before the offset is never rewritten
+    os.makedirs(CANDLE_CACHE_DIR, exist_ok=True)
+    path = _path_for(symbol)
+
+    mode = "r+b" if offset > 0 and os.path.exists(path) else "wb"
+    with open(path, mode) as f:
+        f.seek(offset * CANDLE_DTYPE.itemsize)
+        f.truncate()
+        records.tofile(f)
+
+    # Objects can't be appended to, the whole file goes up again. A year of bars is under 20KB.
+    try:
+        storage.persist(path, _key_for(symbol))
+    except storage.STORAGE_ERRORS as exc:
+        # The records are still served, only the next cold start has to fetch them again
+        logger.error(f"Failed to persist candles for {symbol}: {exc}")
+
+
+def check_consistency(symbol, records):
+    if len(records) == 0:
+        raise CandleCacheError(f"No candles stored for {symbol}")
+
+    timestamps = records["datetime"]
+    gaps = np.diff(timestamps)
+
+    if np.any(gaps <= 0):
+        raise CandleCacheError(f"Candles for {symbol} are not strictly increasing")
+
+    if np.any(gaps > MAX_GAP_DAYS * DAY_MS):
+        gap_index = int(np.argmax(gaps > MAX_GAP_DAYS * DAY_MS))
+        raise CandleCacheError(
+            f"Candles for {symbol} are missing bars after {datetime.fromtimestamp(timestamps[gap_index] / 1000).date()}")
+
+    prices = np.stack([records["open"], records["high"], records["low"], records["close"]])
+    if not np.all(np.isfinite(prices)) or np.any(prices <= 0):
+        raise CandleCacheError(f"Candles for {symbol} contain invalid prices")
+
+    if np.any(records["low"] > records["high"]):
+        raise CandleCacheError(f"Candles for {symbol} have a low above the high")
+
+
+def _fetch_full(symbol):
+    records = _to_records(get_price_history(symbol))
+    _write(symbol, records)
+    return records
+
+
+def _refresh(symbol, now_ms):
+    try:
+        stored = _load(symbol)
+        check_consistency(symbol, stored)
+    except CandleCacheError as exc:
+        logger.info(f"Fetching full price history for {symbol}: {exc}")
+        return _fetch_full(symbol)
+
+    last_timestamp = int(stored["datetime"][-1])
+
+    # Ask again for the last stored bar as well, it may have been stored before the day closed
+    delta = _to_records(get_price_history(symbol, start_date=last_timestamp, end_date=now_ms))
+    delta = delta[delta["datetime"] >= last_timestamp]
+
+    if len(delta) == 0:
+        return stored
+
+    if delta["datetime"][0] == last_timestamp:
+        stored_close = stored["close"][-1]
+        last_bar_complete = last_timestamp + DAY_MS <= now_ms
+        if last_bar_complete and abs(delta["close"][0] - stored_close) > CLOSE_TOLERANCE * stored_close:
+            # History was adjusted (split or distribution), nothing stored can be trusted any more
+            logger.info(f"Stored history for {symbol} no longer matches Schwab, fetching full price history")
+            return _fetch_full(symbol)
+
+    offset = int(np.searchsorted(stored["datetime"], delta["datetime"][0]))
+    _write(symbol, delta, offset)
+
+    logger.info(f"Appended {len(delta)} bar(s) to stored price history for {symbol}")
+
+    return np.concatenate([stored[:offset], delta])
+
+
+def get_price_series(symbol):
+    now = datetime.now(timezone.utc)
+    now_ms = int(now.timestamp() * 1000)
+
+    with _lock_for(symbol):
+        records = _refresh(symbol, now_ms)
+
+        try:
+            check_consistency(symbol, records)
+        except CandleCacheError as exc:
+            logger.warning(f"Stored history for {symbol} failed consistency check, fetching full price history: {exc}")
+            records = _fetch_full(symbol)
+
+    # Serve the same one year window a full price history request would return
+    one_year_ago_ms = int((now - relativedelta(years=1)).timestamp() * 1000)
+    records = records[records["datetime"] >= one_year_ago_ms - DAY_MS]
+
+    return PriceSeries.from_records(symbol, records)
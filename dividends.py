@@ -0,0 +1,137 @@
+import json
+import logging
+import os
+import threading
+from datetime import date
+from decimal import Decimal
+
+import metrics
+from lazy import Lazy
+import storage
+from ratelimit import TokenBucket
+from ssm import get_secret
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+# Working copy of the dividend document, backed by storage.STATE_BUCKET when it is set
+DIVIDEND_CACHE_PATH = os.environ.get("DIVIDEND_CACHE_PATH", "/tmp/algotrading-dividends.json")
+
+DIVIDEND_CACHE_KEY = "dividends.json"
+
+POLYGON_BASE_URL = os.environ.get("POLYGON_BASE_URL", "https://api.polygon.io")
+
+# Polygon rate limit is 5 requests per second
+POLYGON_REQUESTS_PER_SECOND = 5
+
+
+def _create_client():
+    # Imported here so handlers that never look up dividends don't pay for the polygon package either
+    from polygon import RESTClient
+
+    return RESTClient(api_key=get_secret("/algotrading/polygon/apikey"), base=POLYGON_BASE_URL)
+
+
+polygon_client = Lazy("polygon_client", _create_client)
+
+rate_limiter = TokenBucket(POLYGON_REQUESTS_PER_SECOND)
+
+
+class DividendStore:
+    def __init__(self, path: str, key: str = DIVIDEND_CACHE_KEY):
+        self.path = path
+        self.key = key
+        self._lock = threading.Lock()
+        self._entries = None
+
+    def _load(self):
+        if self._entries is not None:
+            return
+
+        try:
+            restored = storage.restore(self.path, self.key)
+        except storage.STORAGE_ERRORS as exc:
+            # Every ticker is asked of Polygon again instead
+            logger.error(f"Failed to restore dividend cache: {exc}")
+            restored = False
+
+        self._entries = {}
+        if not restored:
+            logger.info("Starting with an empty dividend cache")
+            return
+
+        try:
+            with open(self.path) as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError) as exc:
+            logger.info(f"Starting with an empty dividend cache: {exc}")
+            self._entries = {}
+
+    def _save(self):
+        storage.write_atomically(self.path, json.dumps(self._entries).encode())
+        storage.persist(self.path, self.key)
+
+    def get(self, ticker: str):
+        with self._lock:
+            self._load()
+            return self._entries.get(ticker)
+
+    def update(self, ticker: str, records: list, checked: str):
+        with self._lock:
+            self._load()
+
+            entry = self._entries.setdefault(ticker, {"watermark": None, "dividends": []})
+
+            known = {tuple(record) for record in entry["dividends"]}
+            # Build a new list rather than mutating, readers may still hold the previous one
+            entry["dividends"] = sorted(entry["dividends"] + [record for record in records if tuple(record) not in known])
+
+            if entry["dividends"]:
+                entry["watermark"] = entry["dividends"][-1][0]
+            entry["checked"] = checked
+
+            try:
+                self._save()
+            except (OSError, *storage.STORAGE_ERRORS) as exc:
+                # The entry is still returned, only a later run asks Polygon again
+                logger.warning(f"Unable to persist dividend cache: {exc}")
+
+            return entry
+
+
+store = DividendStore(DIVIDEND_CACHE_PATH)
+
+
+@metrics.timed("polygon.list_dividends")
+def fetch_dividends(ticker: str, after: str = None):
+    rate_limiter.acquire()
+
+    records = []
+    for dividend in polygon_client.get().list_dividends(ticker, ex_dividend_date_gt=after, limit=1000):
+        if dividend.ex_dividend_date is not None and dividend.pay_date is not None:
+            records.append([dividend.ex_dividend_date, dividend.pay_date, str(dividend.cash_amount)])
+
+    return records
+
+
+def get_dividends(ticker: str):
+    today = date.today().isoformat()
+
+    entry = store.get(ticker)
+
+    # Polygon is only asked once per ticker per day, and then only for dividends past the watermark
+    if entry is None or entry.get("checked") != today:
+        watermark = entry["watermark"] if entry is not None else None
+        records = fetch_dividends(ticker, watermark)
+        logger.info(f"Fetched {len(records)} new dividend(s) for {ticker} after {watermark}")
+        entry = store.update(ticker, records, today)
+
+    output = [{
+        'ex_date': date.fromisoformat(ex_date),
+        'payment_date': date.fromisoformat(payment_date),
+        'amount': Decimal(amount)
+    } for ex_date, payment_date, amount in entry["dividends"]]
+
+    logger.info(output)
+
+    return output
@@ -1,22 +1,56 @@
 from decimal import Decimal
 import boto3
+import concurrent.futures
+import logging
 import os
+import random
+import threading
+import time
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+import metrics
+from lazy import Lazy
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
 
-# Initialize a DynamoDB client
-dynamodb = boto3.resource('dynamodb')
 table_name = os.environ['PORTFOLIO_TABLE_NAME']
-table = dynamodb.Table(table_name)
 
+# The DynamoDB resource is only built the first time it is needed
+dynamodb = Lazy("dynamodb_resource", lambda: boto3.resource('dynamodb'))
+
+
+def get_table():
+    return dynamodb.get().Table(table_name)
+
+
+def get_client():
+    # Low level client for the parallel scan and batch writes, unlike the resource it is safe to share between threads
+    return dynamodb.get().meta.client
+
+# Parallel scan segments, each one pages through its share of the table on its own thread
+SCAN_SEGMENTS = int(os.environ.get("PORTFOLIO_SCAN_SEGMENTS", "4"))
+
+# batch_write_item takes at most 25 items per call
+BATCH_WRITE_SIZE = 25
+BATCH_WRITE_MAX_ATTEMPTS = 8
+BATCH_WRITE_BACKOFF = 0.05
 
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+
+@metrics.timed("dynamodb.store_portfolio")
 def store_portfolio(portfolio):
-    table.put_item(
+    get_table().put_item(
        Item=portfolio
     )
 
 
+@metrics.timed("dynamodb.get_portfolio")
 def get_portfolio(account_hash):
     # Example: Get an item
-    response = table.get_item(
+    response = get_table().get_item(
         Key={
             'accountHash': account_hash,
         }
@@ -29,17 +63,97 @@ def get_portfolio(account_hash):
         raise Exception("No portfolio found in dynamodb")
 
 
-def get_all_portfolios():
-    response = table.scan()
+def _scan_segment(segment, total_segments):
+    # Whole items, not a projection. Portfolios are written back with PutRequest, which replaces the item, so an
+    # attribute that wasn't read would be deleted by the write.
+    request = {
+        "TableName": table_name,
+        "Segment": segment,
+        "TotalSegments": total_segments,
+    }
+
+    items = []
+    while True:
+        response = get_client().scan(**request)
+        items.extend({key: _deserializer.deserialize(value) for key, value in item.items()}
+                     for item in response["Items"])
+
+        # If the segment is large and the scan doesn't retrieve all items in one go, paginate
+        if "LastEvaluatedKey" not in response:
+            return items
+        request["ExclusiveStartKey"] = response["LastEvaluatedKey"]
 
-    items = response['Items']
 
-    # If the table is large and the scan doesn't retrieve all items in one go, paginate
-    while 'LastEvaluatedKey' in response:
-        response = table.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
-        items.extend(response['Items'])
+@metrics.timed("dynamodb.get_all_portfolios")
+def get_all_portfolios(total_segments: int = SCAN_SEGMENTS):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=total_segments) as executor:
+        segments = executor.map(_scan_segment, range(total_segments), [total_segments] * total_segments)
+        items = [item for segment in segments for item in segment]
 
     if len(items) == 0:
         raise Exception("No portfolios found in dynamodb")
 
-    return items
\ No newline at end of file
+    return items
+
+
+class PortfolioWriter:
+    # Collects portfolio updates from the worker threads and writes them with batch_write_item
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Keyed by account so a batch never holds the same key twice, which DynamoDB rejects
+        self._pending = {}
+
+    def put(self, portfolio):
+        with self._lock:
+            self._pending[portfolio["accountHash"]] = portfolio
+
+            batch = None
+            if len(self._pending) >= BATCH_WRITE_SIZE:
+                batch = list(self._pending.values())
+                self._pending = {}
+
+        if batch:
+            self._write(batch)
+
+    def flush(self):
+        with self._lock:
+            batch = list(self._pending.values())
+            self._pending = {}
+
+        self._write(batch)
+
+    def _write(self, portfolios):
+        for start in range(0, len(portfolios), BATCH_WRITE_SIZE):
+            self._write_batch(portfolios[start:start + BATCH_WRITE_SIZE])
+
+    @metrics.timed("dynamodb.batch_write_item")
+    def _write_batch(self, portfolios):
+        request = {table_name: [
+            {"PutRequest": {"Item": {key: _serializer.serialize(value) for key, value in portfolio.items()}}}
+            for portfolio in portfolios
+        ]}
+
+        for attempt in range(BATCH_WRITE_MAX_ATTEMPTS):
+            response = get_client().batch_write_item(RequestItems=request)
+
+            request = response.get("UnprocessedItems") or {}
+            if not request:
+                return
+
+            logger.warning(f"{len(request[table_name])} portfolio write(s) unprocessed, retrying")
+            metrics.record_retry()
+            time.sleep(random.uniform(0, BATCH_WRITE_BACKOFF * (2 ** attempt)))
+
+        raise Exception(f"Failed to store {len(request[table_name])} portfolio(s) in dynamodb")
+
+
+portfolio_writer = PortfolioWriter()
+
+
+def buffer_portfolio(portfolio):
+    portfolio_writer.put(portfolio)
+
+
+def flush_portfolios():
+    portfolio_writer.flush()
@@ -0,0 +1,229 @@
+import json
+import logging
+import math
+import os
+import threading
+from collections import deque
+
+import indicators
+import storage
+from series import PriceSeries
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+# Working copy of the indicator state, backed by storage.STATE_BUCKET when it is set
+INDICATOR_STATE_PATH = os.environ.get("INDICATOR_STATE_PATH", "/tmp/algotrading-indicators.json")
+STATE_KEY = "indicators.json"
+
+# Recompute every indicator from the full series as well and fail if the incremental result differs
+VERIFY = os.environ.get("INDICATOR_STATE_VERIFY", "0") == "1"
+
+# Largest difference allowed between the incremental and the batch result
+TOLERANCE = 1e-9
+
+
+class IndicatorStateError(Exception):
+    pass
+
+
+class RelativeStrengthState:
+    # The last 'days' price changes in a ring buffer with their gain and loss sums kept alongside, so a new bar is
+    # one addition and at most one subtraction. Wilder's smoothed averages are carried along from the first bar.
+
+    kind = "rsi"
+
+    def __init__(self, days: int):
+        self.days = days
+        self.gains = deque(maxlen=days)
+        self.losses = deque(maxlen=days)
+        self.gain_sum = 0.0
+        self.loss_sum = 0.0
+        # Appends since the sums were last rebuilt from the buffer
+        self.appends = 0
+        self.wilder_gain = None
+        self.wilder_loss = None
+        self.first_date = None
+        self.last_date = None
+        self.last_close = None
+
+    def append(self, date: str, close: float):
+        if self.last_close is None:
+            self.first_date = date
+        else:
+            change = close - self.last_close
+            gain = max(change, 0.0)
+            loss = max(-change, 0.0)
+
+            if len(self.gains) == self.days:
+                self.gain_sum -= self.gains[0]
+                self.loss_sum -= self.losses[0]
+            self.gains.append(gain)
+            self.losses.append(loss)
+            self.gain_sum += gain
+            self.loss_sum += loss
+
+            # Rounding in the running sums would build up over the years, so they are rebuilt from the buffer once
+            # per trip around it
+            self.appends += 1
+            if self.appends >= self.days:
+                self.gain_sum = math.fsum(self.gains)
+                self.loss_sum = math.fsum(self.losses)
+                self.appends = 0
+
+            if self.wilder_gain is not None:
+                self.wilder_gain = (self.wilder_gain * (self.days - 1) + gain) / self.days
+                self.wilder_loss = (self.wilder_loss * (self.days - 1) + loss) / self.days
+            elif len(self.gains) == self.days:
+                # Seeded with the simple average of the first full window
+                self.wilder_gain = self.gain_sum / self.days
+                self.wilder_loss = self.loss_sum / self.days
+
+        self.last_date = date
+        self.last_close = close
+
+    def value(self):
+        # Matches indicators.relative_strength_index, a simple average over the window
+        if self.loss_sum <= 0:
+            return 100.0
+        return 100 - (100 / (1 + self.gain_sum / self.loss_sum))
+
+    def wilder_value(self):
+        if self.wilder_gain is None:
+            return None
+        if self.wilder_loss == 0:
+            return 100.0
+        return 100 - (100 / (1 + self.wilder_gain / self.wilder_loss))
+
+    def to_dict(self):
+        return {
+            "days": self.days,
+            "gains": list(self.gains),
+            "losses": list(self.losses),
+            "appends": self.appends,
+            "wilder_gain": self.wilder_gain,
+            "wilder_loss": self.wilder_loss,
+            "first_date": self.first_date,
+            "last_date": self.last_date,
+            "last_close": self.last_close,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        state = cls(data["days"])
+        state.gains.extend(data["gains"])
+        state.losses.extend(data["losses"])
+        state.gain_sum = math.fsum(state.gains)
+        state.loss_sum = math.fsum(state.losses)
+        state.appends = data["appends"]
+        state.wilder_gain = data["wilder_gain"]
+        state.wilder_loss = data["wilder_loss"]
+        state.first_date = data["first_date"]
+        state.last_date = data["last_date"]
+        state.last_close = data["last_close"]
+        return state
+
+
+class IndicatorStateStore:
+    # Every symbol, indicator and window in one JSON document, read once and written back once per run. Each run only
+    # appends the bars that arrived since the previous one, and starts over from the full series when the stored
+    # state can't be continued from it.
+
+    STATE_CLASSES = {RelativeStrengthState.kind: RelativeStrengthState}
+
+    def __init__(self, path: str, key: str = STATE_KEY):
+        self.path = path
+        self.key = key
+        self._lock = threading.Lock()
+        self._states = None
+        self._dirty = False
+
+    def _load(self):
+        if self._states is not None:
+            return
+
+        self._states = {}
+        try:
+            restored = storage.restore(self.path, self.key)
+        except storage.STORAGE_ERRORS as exc:
+            # Every indicator is rebuilt from the full series instead
+            logger.error(f"Failed to restore indicator state: {exc}")
+            restored = False
+
+        try:
+            if restored:
+                with open(self.path) as f:
+                    for name, data in json.load(f).items():
+                        symbol, kind, days = name.rsplit(".", 2)
+                        if kind in self.STATE_CLASSES:
+                            self._states[(symbol, kind, int(days))] = self.STATE_CLASSES[kind].from_dict(data)
+        except (OSError, ValueError, KeyError) as exc:
+            logger.info(f"Starting with no indicator state: {exc}")
+            self._states = {}
+
+    def save(self):
+        # Called once the run's indicators are all computed, so a day's updates cost one write
+        with self._lock:
+            if not self._dirty:
+                return
+
+            document = {f"{symbol}.{kind}.{days}": state.to_dict()
+                        for (symbol, kind, days), state in self._states.items()}
+            storage.write_atomically(self.path, json.dumps(document).encode())
+            self._dirty = False
+
+            try:
+                storage.persist(self.path, self.key)
+            except storage.STORAGE_ERRORS as exc:
+                # Only tomorrow's cold start pays for this with a rebuild, today's trading goes ahead
+                logger.error(f"Failed to persist indicator state: {exc}")
+
+    def _advance(self, series: PriceSeries, state_class, days: int):
+        key = (series.symbol, state_class.kind, days)
+
+        with self._lock:
+            self._load()
+            state = self._states.get(key)
+
+            start = None
+            if state is not None and state.last_date is not None:
+                index = series.index_of(state.last_date)
+                # The bar the state stopped at must still be in the series with the same close, otherwise history
+                # was revised or the state is from a different series
+                if index is not None and series.close[index] == state.last_close:
+                    start = index + 1
+
+            if start is None:
+                logger.info(f"Rebuilding indicator state for {key} from {len(series)} bars")
+                state = self._states[key] = state_class(days)
+                start = 0
+
+            if start < len(series):
+                for index in range(start, len(series)):
+                    state.append(str(series.dates[index]), float(series.close[index]))
+                self._dirty = True
+
+            return state
+
+    def relative_strength_index(self, series: PriceSeries, days: int, verify: bool = VERIFY):
+        state = self._advance(series, RelativeStrengthState, days)
+        value = state.value()
+
+        if verify:
+            check_agreement(series.symbol, "RSI", value, indicators.relative_strength_index(series, days))
+
+            # Wilder's averages depend on every bar since the first, so they can only be checked when the series
+            # still starts where the state did
+            wilder = state.wilder_value()
+            if wilder is not None and str(series.dates[0]) == state.first_date:
+                check_agreement(series.symbol, "Wilder RSI", wilder, indicators.wilder_relative_strength_index(series, days))
+
+        return value
+
+
+def check_agreement(symbol, name, incremental, batch):
+    if not math.isclose(incremental, batch, rel_tol=TOLERANCE, abs_tol=TOLERANCE):
+        raise IndicatorStateError(f"Incremental {name} for {symbol} is {incremental}, full recompute gives {batch}")
+
+
+store = IndicatorStateStore(INDICATOR_STATE_PATH)
@@ -0,0 +1,191 @@
+from decimal import Decimal
+
+import numpy as np
+
+from series import PriceSeries
+
+
+def _decimal(value):
+    # Same conversion the candle dicts always went through, so exact mode matches the original implementation
+    return Decimal(str(float(value)))
+
+
+def moving_average(series: PriceSeries, days: int, exact: bool = False):
+    closes = series.close[-days:]
+
+    if exact:
+        total = Decimal(0)
+        for close in closes[::-1]:
+            total += _decimal(close)
+        return total / days
+
+    return float(closes.sum() / days)
+
+
+def relative_strength_index(series: PriceSeries, days: int, exact: bool = False):
+    # Only the last 'days' changes contribute, so only those are computed
+    closes = series.close[-(days + 1):]
+
+    if exact:
+        price_changes = [_decimal(closes[i + 1]) - _decimal(closes[i]) for i in range(len(closes) - 1)]
+        avg_gain = sum(max(change, 0) for change in price_changes) / days
+        avg_loss = sum(abs(min(change, 0)) for change in price_changes) / days
+
+        rs = avg_gain / avg_loss if avg_loss != 0 else float('inf')  # Avoid division by zero
+        return 100 - (100 / (1 + rs))
+
+    changes = np.diff(closes)
+    avg_gain = np.clip(changes, 0, None).sum() / days
+    avg_loss = -np.clip(changes, None, 0).sum() / days
+
+    if avg_loss == 0:
+        return 100.0
+
+    return float(100 - (100 / (1 + avg_gain / avg_loss)))
+
+
+def wilder_relative_strength_index(series: PriceSeries, days: int):
+    # Wilder's smoothing over the whole series: the first 'days' changes are averaged, every later change is
+    # blended in with weight 1/days. NaN until there are 'days' changes.
+    changes = np.diff(series.close)
+    if len(changes) < days:
+        return float("nan")
+
+    gains = np.clip(changes, 0, None)
+    losses = -np.clip(changes, None, 0)
+
+    avg_gain = gains[:days].sum() / days
+    avg_loss = losses[:days].sum() / days
+    for gain, loss in zip(gains[days:], losses[days:]):
+        avg_gain = (avg_gain * (days - 1) + gain) / days
+        avg_loss = (avg_loss * (days - 1) + loss) / days
+
+    if avg_loss == 0:
+        return 100.0
+
+    return float(100 - (100 / (1 + avg_gain / avg_loss)))
+
+
+def _dividends_in_window(series: PriceSeries, dividends: list[dict], start_index: int):
+    # Dividends with an ex-date inside (start, end] that were paid on a day we have a close for
+    date_start = series.dates[start_index]
+    date_end = series.dates[-1]
+
+    selected = []
+    for dividend in dividends:
+        ex_date = np.datetime64(dividend['ex_date'], "D")
+        if date_start < ex_date <= date_end:
+            pay_index = series.index_of(dividend['payment_date'])
+            if pay_index is not None:
+                selected.append((dividend['amount'], pay_index))
+
+    return selected
+
+
+def cumulative_return(series: PriceSeries, dividends: list[dict], days: int, exact: bool = False):
+    start_index = max(len(series) - days, 0)
+
+    reinvested = _dividends_in_window(series, dividends or [], start_index)
+
+    if exact:
+        price_today = _decimal(series.close[-1])
+        price_n_days_ago = _decimal(series.close[start_index])
+
+        shares_owned = Decimal('1')
+        for amount, pay_index in reinvested:
+            shares_owned += (shares_owned * Decimal(str(amount))) / _decimal(series.close[pay_index])
+
+        return (shares_owned * price_today - price_n_days_ago) / price_n_days_ago
+
+    price_today = series.close[-1]
+    price_n_days_ago = series.close[start_index]
+
+    shares_owned = 1.0
+    if reinvested:
+        amounts = np.array([float(amount) for amount, _ in reinvested])
+        pay_prices = series.close[[pay_index for _, pay_index in reinvested]]
+        shares_owned = float(np.prod(1 + amounts / pay_prices))
+
+    return float((shares_owned * price_today - price_n_days_ago) / price_n_days_ago)
+
+
+class TotalReturnSeries:
+    # Closes adjusted for reinvested dividends, built once per ticker so every N-day return ending at the last bar is
+    # a single division. The dividends reinvested are the ones cumulative_return would reinvest: paid on a day we have
+    # a close for, with an ex-date no later than the last bar.
+
+    __slots__ = ("series", "factor", "adjusted", "_positions")
+
+    def __init__(self, series: PriceSeries, dividends: list[dict]):
+        self.series = series
+        self._positions = {int(day): index for index, day in enumerate(series.dates.astype(np.int64))}
+
+        # factor[i] is the number of shares one share bought before the data began has grown to by bar i, counting
+        # each dividend from the first bar on or after its ex-date
+        growth = np.ones(len(series))
+        for dividend in dividends or []:
+            pay_index = self.index_of(dividend['payment_date'])
+            ex_date = np.datetime64(dividend['ex_date'], "D")
+            if pay_index is None or ex_date > series.dates[-1]:
+                continue
+
+            ex_index = int(np.searchsorted(series.dates, ex_date))
+            growth[ex_index] *= 1 + float(dividend['amount']) / series.close[pay_index]
+
+        self.factor = np.cumprod(growth)
+        self.adjusted = series.close * self.factor
+
+    def index_of(self, date):
+        # Same as PriceSeries.index_of, from a dictionary instead of a search
+        return self._positions.get(int(np.datetime64(date, "D").astype(np.int64)))
+
+    def cumulative_return(self, days: int):
+        # Dividends with an ex-date after the first bar of the window grew the shares held by factor[-1] / factor[start]
+        start_index = max(len(self.series) - days, 0)
+        return float(self.adjusted[-1] / self.adjusted[start_index] - 1)
+
+
+def rolling_relative_strength_index(series: PriceSeries, days: int):
+    # relative_strength_index as of every bar at once, element t only uses closes up to and including bar t.
+    # Bars without 'days' changes behind them are NaN.
+    changes = np.diff(series.close)
+    gains = np.concatenate([[0.0], np.cumsum(np.clip(changes, 0, None))])
+    losses = np.concatenate([[0.0], np.cumsum(-np.clip(changes, None, 0))])
+
+    rsi = np.full(len(series), np.nan)
+    if len(series) <= days:
+        return rsi
+
+    avg_gain = (gains[days:] - gains[:-days]) / days
+    avg_loss = (losses[days:] - losses[:-days]) / days
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rsi[days:] = np.where(avg_loss == 0, 100.0, 100 - (100 / (1 + avg_gain / avg_loss)))
+
+    return rsi
+
+
+def rolling_cumulative_return(series: PriceSeries, dividends: list[dict], days: int):
+    # cumulative_return as of every bar at once. A dividend is only reinvested at bar t when its payment date had
+    # already happened by t, exactly as if the history ended at t. Bars without 'days' bars behind them are NaN.
+    count = len(series)
+    returns = np.full(count, np.nan)
+    if count < days:
+        return returns
+
+    end = np.arange(days - 1, count)
+    start = end - (days - 1)
+
+    log_shares = np.zeros(len(end))
+    for dividend in dividends or []:
+        pay_index = series.index_of(dividend['payment_date'])
+        if pay_index is None:
+            continue
+
+        ex_date = np.datetime64(dividend['ex_date'], "D")
+        reinvested = (series.dates[start] < ex_date) & (ex_date <= series.dates[end]) & (pay_index <= end)
+        log_shares[reinvested] += np.log1p(float(dividend['amount']) / series.close[pay_index])
+
+    returns[end] = np.exp(log_shares) * series.close[end] / series.close[start] - 1
+
+    return returns
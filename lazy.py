@@ -0,0 +1,37 @@
+import threading
+
+import metrics
+
+
+class Lazy:
+    # Builds a value the first time it is asked for and hands the same one out afterwards. Module level instances
+    # outlive the invocation, so a warm Lambda container never pays for the same client twice.
+
+    def __init__(self, name: str, factory):
+        self.name = name
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._value = None
+        self._created = False
+
+    @property
+    def created(self):
+        return self._created
+
+    def get(self):
+        if self._created:
+            return self._value
+
+        # Only one thread builds the value, the rest block here and pick it up
+        with self._lock:
+            if not self._created:
+                with metrics.timed(f"init.{self.name}"):
+                    self._value = self._factory()
+                self._created = True
+
+        return self._value
+
+    def reset(self):
+        with self._lock:
+            self._value = None
+            self._created = False
@@ -1,346 +1,157 @@
 import concurrent.futures
-import copy
 import logging
-import time
 import traceback
-from workalendar.usa import UnitedStates
-from datetime import datetime, timedelta, timezone
-from decimal import Decimal
-from polygon import RESTClient
-
-from dynamodb import store_portfolio, get_all_portfolios
-from schwab import get_price_history, get_orders, cancel_order, get_current_quotes, place_market_order, get_order, \
-    get_account, place_trailing_stop_order
-from ssm import get_secret
+from datetime import datetime, timedelta
+from functools import partial
+
+import metrics
+from allocation import CASH_RESERVE, MAX_WEIGHT_DEVIATION, allocate_remaining_amount
+from dynamodb import buffer_portfolio, flush_portfolios, get_all_portfolios
+from money import Money, Quantity
+from orders import TERMINAL_ORDER_STATUSES, OrderSubmissionError, cancel_open_orders, submit_orders, track_orders
+from parameters import Parameters
+from portfolio import Portfolio
+from quotes import quote_service
+from schwab import POOL_SIZE, place_market_order, get_account, place_trailing_stop_order
 
 logger = logging.getLogger()
 logger.setLevel("INFO")
 
-client = RESTClient(api_key=get_secret("/algotrading/polygon/apikey"))
-
-TRAILING_STOP_PERCENTAGE = 4.75
-
-def create_strategy():
-    data = {
-        "AGG": get_price_history("AGG"),
-        "BIL": get_price_history("BIL"),
-        "SOXL": get_price_history("SOXL"),
-        "TQQQ": get_price_history("TQQQ"),
-        "UPRO": get_price_history("UPRO"),
-        "TECL": get_price_history("TECL"),
-        "TLT": get_price_history("TLT"),
-        "QID": get_price_history("QID"),
-        "TBF": get_price_history("TBF"),
-    }
-
-    if (calculate_cumulative_return("AGG", data, 60) >
-            calculate_cumulative_return("BIL", data, 60)):
-        logger.info("Strategy selected: risk on")
-        options = ["SOXL", "TQQQ", "UPRO", "TECL"]
-        strengths = [(stock, calculate_relative_strength_index(stock, data, 10)) for stock in options]
-        sorted_stocks = sorted(strengths, key=lambda x: x[1])
-        logger.info(f"Stocks sorted by 10 day RSI: {sorted_stocks}")
-        bottom_two_stocks = sorted_stocks[:2]
-        logger.info(f"Top two stocks: {bottom_two_stocks}")
-        return [x[0] for x in bottom_two_stocks]
-    else:
-        if (calculate_cumulative_return("TLT", data, 20) <
-                calculate_cumulative_return("BIL", data, 20)):
-            logger.info("Strategy selected: risk off, rising rates")
-            options = ["QID", "TBF"]
-            strengths = [(stock, calculate_relative_strength_index(stock, data, 20)) for stock in options]
-            sorted_stocks = sorted(strengths, key=lambda x: x[1])
-            logger.info(f"Stocks sorted by 20 day RSI: {sorted_stocks}")
-            bottom_stock = sorted_stocks[0]
-            logger.info(f"UUP, {bottom_stock}")
-            return ["UUP", bottom_stock[0]]
-        else:
-            logger.info("Strategy selected: risk off, falling rates")
-            logger.info("UGL, TMF, BTAL, XLP")
-            return ["UGL", "TMF", "BTAL", "XLP"]
-
-
-def calculate_moving_average(ticker, data, days):
-    ticker_data = data[ticker]
-
-    # Sort the data by datetime in descending order
-    ticker_data.sort(key=lambda x: x['datetime'], reverse=True)
-
-    # Initialize the total
-    total = Decimal(0)
-
-    # Iterate over the first 'days' elements
-    for i in range(days):
-        total += Decimal(str(ticker_data[i]['close']))
-
-    # Calculate and return the average
-    return total / days
-
-
-def calculate_relative_strength_index(ticker, data, days):
-    ticker_data = data[ticker]
-
-    # Sort the data by datetime in ascending order so the most recent comes last
-    ticker_data.sort(key=lambda x: x['datetime'])
-
-    # Calculate daily price changes
-    price_changes = [Decimal(str(ticker_data[i + 1]['close'])) - Decimal(str(ticker_data[i]['close'])) for i in range(len(ticker_data) - 1)]
-
-    # Initialize gains and losses
-    gains = [max(change, 0) for change in price_changes]
-    losses = [abs(min(change, 0)) for change in price_changes]
-
-    # Calculate the average gain and average loss using exponential moving average
-    avg_gain = sum(gains[-days:]) / days
-    avg_loss = sum(losses[-days:]) / days
-
-    # Calculate the RS and RSI
-    rs = avg_gain / avg_loss if avg_loss != 0 else float('inf')  # Avoid division by zero
-    rsi = 100 - (100 / (1 + rs))
-
-    return rsi
-
-
-def calculate_cumulative_return(ticker, overall_data, days):
-    dividends = get_dividends(ticker)
-    ticker_data = overall_data[ticker]
-
-    # Sort the data by datetime in ascending order
-    ticker_data.sort(key=lambda x: x['datetime'], reverse=True)
-
-    print(
-        f"Starting date {datetime.fromtimestamp(ticker_data[0]['datetime'] / 1000).date()} ending date {datetime.fromtimestamp(ticker_data[-1]['datetime'] / 1000).date()}")
-
-    # Get the closing price for the first day and the 'days'th day
-    price_today = Decimal(str(ticker_data[0]['close']))
-    price_n_days_ago = Decimal(str(ticker_data[days - 1]['close'])) if len(ticker_data) > days - 1 else Decimal(
-        str(ticker_data[-1]['close']))
-
-    date_today = datetime.fromtimestamp(ticker_data[0]['datetime'] / 1000).date()
-    date_n_days_ago = datetime.fromtimestamp(ticker_data[days - 1]['datetime'] / 1000).date()
-
-    # Initialize the number of shares with initial investment
-    shares_owned = Decimal('1')  # Assuming initial shares owned
-
-    # Iterate over dividends
-    if dividends:
-        for dividend in dividends:
-            ex_date = dividend['ex_date'].date()
-            payment_date = dividend['payment_date'].date()
-            # Check if the ex-date is within the required period
-            if date_n_days_ago < ex_date <= date_today:
-                # Find price at payment date
-                pay_price = next((item for item in ticker_data if
-                                  datetime.fromtimestamp(item['datetime'] / 1000).date() == payment_date), None)
+STRATEGY_PARAMETERS = Parameters()
 
-                if pay_price:
-                    pay_price = Decimal(str(pay_price['close']))
-                    additional_shares = (shares_owned * Decimal(str(dividend['amount']))) / Decimal(str(pay_price))
-                    shares_owned += additional_shares
+TRAILING_STOP_PERCENTAGE = STRATEGY_PARAMETERS.trailing_stop_percentage
 
-    # Calculate the final value with reinvested dividends
-    final_value = shares_owned * price_today
-    cumulative_return = (final_value - price_n_days_ago) / price_n_days_ago
+def create_strategies(names, parameters: Parameters = STRATEGY_PARAMETERS):
+    # Only the rebalance evaluates strategies, the cancel job shouldn't pay to import numpy and the state storage
+    import indicator_state
+    import strategy
 
-    logger.info(
-        f"Cumulative return for {ticker}: {cumulative_return}, Dividends reinvested: {shares_owned - Decimal('1')}")
+    # Every named strategy decided from one snapshot. Only the branches some strategy takes are fetched, each symbol
+    # and indicator once however many strategies reach it.
+    trees = {name: strategy.STRATEGIES[name](parameters) for name in names}
+    snapshot = strategy.Snapshot.build(list(trees.values()))
+    desired_stocks = {name: strategy.evaluate(tree, snapshot) for name, tree in trees.items()}
 
-    # Return the cumulative return
-    return cumulative_return
+    # The day's indicator updates are written once, for tomorrow's run to continue from
+    indicator_state.store.save()
 
+    return desired_stocks
 
-def get_dividends(ticker):
-    time.sleep(0.2)  # Polygon rate limit is 5 requests per second
 
-    date_format = "%Y-%m-%d"
+def strategy_name(portfolio: Portfolio):
+    import strategy
 
-    dividends = client.list_dividends(ticker, limit=1000)
-
-    output = []
-
-    for dividend in dividends:
-        if dividend.ex_dividend_date is not None and dividend.pay_date is not None:
-            output.append({
-                'ex_date': datetime.strptime(dividend.ex_dividend_date, date_format),
-                'payment_date': datetime.strptime(dividend.pay_date, date_format),
-                'amount': Decimal(str(dividend.cash_amount))
-            })
-
-    logger.info(output)
-
-    return output
-
-
-def format_time_schwab(time_obj):
-    return time_obj.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+    return portfolio.attributes.get("strategy", strategy.DEFAULT_STRATEGY)
 
 
 def cancel_outstanding_orders(account_hash: str):
     logger.info(f"Cancelling outstanding orders in account {account_hash}")
 
-    now = datetime.now(timezone.utc)
-    past = now - timedelta(days=2)
-
-    from_time = format_time_schwab(past)
-    to_time = format_time_schwab(now)
-
-    orders = get_orders(account_hash, from_time, to_time)
-
-    for order in orders:
-        if order["cancelable"]:
-            cancel_order(account_hash, order["orderId"])
-            logger.info(f"Order {order['orderId']} has been canceled")
-        else:
-            logger.info(f"Order {order['orderId']} is not cancelable")
-
-
-def get_ask_price(current_quotes, stock):
-    if stock not in current_quotes:
-        logger.warning(f"{stock} NOT IN FETCHED QUOTES")
-    else:
-        information = current_quotes[stock]
-
-        if not information["realtime"]:
-            logger.warning(f"NOT REALTIME QUOTE FOR {stock}")
-
-        quote = information["quote"]
-        return Decimal(str(quote["askPrice"]))
-
-
-def get_bid_price(current_quotes, stock):
-    if stock not in current_quotes:
-        logger.warning(f"{stock} NOT IN FETCHED QUOTES")
-    else:
-        information = current_quotes[stock]
+    return cancel_open_orders(account_hash)
 
-        if not information["realtime"]:
-            logger.warning(f"NOT REALTIME QUOTE FOR {stock}")
 
-        quote = information["quote"]
-        return Decimal(str(quote["bidPrice"]))
+def _get_quote(stock):
+    quote = quote_service.get(stock)
 
-def get_last_price(current_quotes, stock):
-    if stock not in current_quotes:
+    if quote is None:
         logger.warning(f"{stock} NOT IN FETCHED QUOTES")
-    else:
-        information = current_quotes[stock]
+    elif not quote.realtime:
+        logger.warning(f"NOT REALTIME QUOTE FOR {stock}")
 
-        if not information["realtime"]:
-            logger.warning(f"NOT REALTIME QUOTE FOR {stock}")
+    return quote
 
-        quote = information["quote"]
-        return Decimal(str(quote["lastPrice"]))
 
+def get_ask_price(stock):
+    quote = _get_quote(stock)
+    if quote is not None:
+        return quote.ask
 
-def get_value_of_portfolio(portfolio):
-    current_quotes = get_current_quotes(portfolio["positions"].keys())
 
-    total_value = Decimal(str(portfolio["cash"]))
+def get_bid_price(stock):
+    quote = _get_quote(stock)
+    if quote is not None:
+        return quote.bid
 
-    for symbol, quantity in portfolio["positions"].items():
-        # use ask price instead of bid price to ensure that we don't arbitrarially sell stocks
-        total_value += get_ask_price(current_quotes, symbol) * Decimal(str(quantity))
 
-    return total_value
+def get_last_price(stock):
+    quote = _get_quote(stock)
+    if quote is not None:
+        return quote.last
 
 
-def allocate_remaining_amount(current_quotes, desired_positions, amount_to_spend: Decimal):
-    best_desired_positions = desired_positions
-    best_amount_to_spend = amount_to_spend
-    for symbol in desired_positions.keys():
-        price = get_ask_price(current_quotes, symbol)
-        if price < amount_to_spend:
-            new_desired_positions = copy.deepcopy(desired_positions)
-            new_desired_positions[symbol] += Decimal(1)
+def get_value_of_portfolio(portfolio: Portfolio):
+    quote_service.prefetch(list(portfolio.positions))
 
-            further_desired_positions, further_amount_to_spend = allocate_remaining_amount(current_quotes, new_desired_positions, amount_to_spend - price)
+    # use ask price instead of bid price to ensure that we don't arbitrarially sell stocks
+    prices = {symbol: get_ask_price(symbol) for symbol in portfolio.positions}
 
-            if further_amount_to_spend < best_amount_to_spend:
-                best_desired_positions = further_desired_positions
-                best_amount_to_spend = further_amount_to_spend
+    return portfolio.value(prices)
 
-    return best_desired_positions, best_amount_to_spend
 
+def determine_desired_positions(stocks: list[str], amount_to_spend: Money):
+    quote_service.prefetch(stocks)
 
-def determine_desired_positions(stocks: list[str], amount_to_spend: Decimal):
-    current_quotes = get_current_quotes(stocks)
+    amount_to_spend -= amount_to_spend * CASH_RESERVE
 
     desired_positions = {}
 
-    amount_per_stock = amount_to_spend / Decimal(len(stocks))
+    amount_per_stock = amount_to_spend / len(stocks)
 
-    amount_spent = Decimal(0)
+    prices = {}
+    amount_spent = Money(0)
     for symbol in stocks:
-        price = get_ask_price(current_quotes, symbol)
+        price = get_ask_price(symbol)
 
-        quantity = amount_per_stock // price
+        quantity = Quantity.of(amount_per_stock // price)
 
+        prices[symbol] = price
         desired_positions[symbol] = quantity
         amount_spent += price * quantity
 
     logger.info(f"Initial allocation: {desired_positions}")
 
-    # best_desired_positions, _ = allocate_remaining_amount(current_quotes, desired_positions, amount_to_spend - amount_spent)
-    #
-    # desired_positions = best_desired_positions
+    max_position_value = amount_per_stock + amount_to_spend * MAX_WEIGHT_DEVIATION
+    desired_positions, amount_left = allocate_remaining_amount(prices, desired_positions,
+                                                               amount_to_spend - amount_spent, max_position_value)
 
-    logger.info(f"After allocating remaining amount: {desired_positions}")
+    logger.info(f"After allocating remaining amount: {desired_positions}, {amount_left} left over")
 
     return desired_positions
 
 
-def determine_position_changes(current_positions: dict[str, Decimal], desired_positions):
+def determine_position_changes(current_positions: dict[str, Quantity], desired_positions: dict[str, Quantity]):
     sell = {}
     buy = {}
 
-    non_zero_current_positions = {stock for stock, quantity in current_positions.items() if quantity != Decimal(0)}
+    # Compared on the raw micro-units, this runs for every account
+    non_zero_current_positions = {stock for stock, quantity in current_positions.items() if quantity.micros}
     if non_zero_current_positions != desired_positions.keys():
 
         stocks = set(current_positions.keys()) | set(desired_positions.keys())
 
         for stock in stocks:
             if stock not in desired_positions.keys():
-                if current_positions[stock] != Decimal(0):
+                if current_positions[stock].micros:
                     sell[stock] = current_positions[stock]
             elif stock not in current_positions.keys():
-                if desired_positions[stock] != Decimal(0):
+                if desired_positions[stock].micros:
                     buy[stock] = desired_positions[stock]
             else:
-                quantity_to_buy = desired_positions[stock] - current_positions[stock]
-                if quantity_to_buy > Decimal(0):
-                    buy[stock] = quantity_to_buy
-                elif quantity_to_buy < Decimal(0):
-                    sell[stock] = -quantity_to_buy
+                quantity_to_buy = desired_positions[stock].micros - current_positions[stock].micros
+                if quantity_to_buy > 0:
+                    buy[stock] = Quantity(quantity_to_buy)
+                elif quantity_to_buy < 0:
+                    sell[stock] = Quantity(-quantity_to_buy)
 
     return sell, buy
 
 
-def get_filled_order_confirmations(account_hash, orders):
-    order_confirmations = []
-
-    for symbol, order_id in orders:
-        while True:
-            logger.info(f"Checking order {order_id} for {symbol}")
-
-            order_details = get_order(account_hash, order_id)
-
-            logger.info(f"Order details: {order_details}")
-
-            if order_details["status"] in ["FILLED", "REJECTED", "CANCELED", "EXPIRED", "REPLACED"]:
-                order_confirmations.append((symbol, order_details))
-                break
-            else:
-                time.sleep(1)
-
-    return order_confirmations
-
-
 def get_excecuted_order_value(order_details):
-    value = Decimal(0)
+    value = Money(0)
 
     for activity in order_details["orderActivityCollection"]:
         for leg in activity["executionLegs"]:
-            value += Decimal(str(leg["quantity"])) * Decimal(str(leg["price"]))
+            value += Quantity.of(leg["quantity"]) * Money.of(leg["price"])
 
     return value
 
@@ -349,6 +160,9 @@ def get_n_business_days_ago(n):
     # Get today's date
     today = datetime.today().date()
 
+    # Only the rebalance needs the holiday calendar, the cancel job shouldn't pay to import it
+    from workalendar.usa import UnitedStates
+
     # Initialize the work calendar for the United States
     cal = UnitedStates()
 
@@ -365,125 +179,215 @@ def get_n_business_days_ago(n):
     return current_date
 
 
-def run_for_portfolio(current_portfolio, desired_stocks):
-    account_hash = current_portfolio["accountHash"]
+def run_for_portfolio(current_portfolio: Portfolio, desired_stocks):
+    account_hash = current_portfolio.account_hash
+
+    with metrics.portfolio_context(account_hash), metrics.timed("phase.portfolio", phase=True):
+        process_portfolio(current_portfolio, desired_stocks)
 
-    logger.info(f"Processing account with hash {account_hash}")
 
-    account_info = get_account(account_hash)
-    current_portfolio["cash"] = Decimal(str(account_info["securitiesAccount"]["currentBalances"]["availableFunds"]))
+def process_portfolio(current_portfolio: Portfolio, desired_stocks):
+    account_hash = current_portfolio.account_hash
 
-    current_positions = {}
-    if "positions" in account_info["securitiesAccount"]:
-        for position in account_info["securitiesAccount"]["positions"]:
-            current_positions[position["instrument"]["symbol"]] = Decimal(str(position["longQuantity"]))
+    logger.info(f"Processing account with hash {account_hash}")
 
-    current_portfolio["positions"] = current_positions
+    with metrics.timed("phase.valuation", phase=True):
+        account_info = get_account(account_hash)
+        current_portfolio.update_from_account(account_info)
 
-    logger.info(f"Current portfolio: {current_portfolio}")
+        logger.info(f"Current portfolio: {current_portfolio}")
 
-    portfolio_value = get_value_of_portfolio(current_portfolio)
+        portfolio_value = get_value_of_portfolio(current_portfolio)
 
     logger.info(f"Portfolio value: {portfolio_value}")
 
-    cancel_outstanding_orders(account_hash)
+    with metrics.timed("phase.cancel", phase=True):
+        cancel_outstanding_orders(account_hash)
 
-    desired_positions = determine_desired_positions(desired_stocks, portfolio_value)
+    with metrics.timed("phase.allocation", phase=True):
+        desired_positions = determine_desired_positions(desired_stocks, portfolio_value)
 
-    logger.info(f"Desired positions: {desired_positions}")
+        logger.info(f"Desired positions: {desired_positions}")
 
-    sell_positions, buy_positions = determine_position_changes(current_portfolio["positions"], desired_positions)
+        sell_positions, buy_positions = determine_position_changes(current_portfolio.quantities(), desired_positions)
 
     logger.info(f"Selling positions: {sell_positions}")
     logger.info(f"Buying positions: {buy_positions}")
 
     order_confirmations = []
+    order_failures = []
 
-    sell_orders = [(symbol, place_market_order(account_hash, symbol, int(quantity), "SELL")) for symbol, quantity in
-                   sell_positions.items()]
+    # Sells have to fill before buys are placed so their cash is available, within a stage orders go out together
+    with metrics.timed("phase.sells", phase=True):
+        sell_orders, failures = submit_orders("SELL", [
+            (symbol, partial(place_market_order, account_hash, symbol, int(quantity), "SELL"))
+            for symbol, quantity in sell_positions.items()])
+        order_failures.extend(failures)
 
-    order_confirmations.extend(get_filled_order_confirmations(account_hash, sell_orders))
+        order_confirmations.extend(track_orders(account_hash, sell_orders))
 
-    buy_orders = [(symbol, place_market_order(account_hash, symbol, int(quantity), "BUY")) for symbol, quantity in
-                  buy_positions.items()]
+    with metrics.timed("phase.buys", phase=True):
+        buy_orders, failures = submit_orders("BUY", [
+            (symbol, partial(place_market_order, account_hash, symbol, int(quantity), "BUY"))
+            for symbol, quantity in buy_positions.items()])
+        order_failures.extend(failures)
 
-    order_confirmations.extend(get_filled_order_confirmations(account_hash, buy_orders))
+        order_confirmations.extend(track_orders(account_hash, buy_orders))
 
-    net_cash = Decimal(0)
+    # Orders still open after being cancelled at the deadline, their shares get no stop until they settle
+    unresolved = set()
     for symbol, order_details in order_confirmations:
-        if order_details["status"] == "FILLED":
-            if symbol not in current_portfolio["positions"]:
-                current_portfolio["positions"][symbol] = Decimal(0)
-
-            if order_details["orderLegCollection"][0]["instruction"] == "SELL":
-                current_portfolio["positions"][symbol] -= Decimal(str(order_details["filledQuantity"]))
-                net_cash += get_excecuted_order_value(order_details)
-            else:
-                current_portfolio["positions"][symbol] += Decimal(str(order_details["filledQuantity"]))
-                net_cash -= get_excecuted_order_value(order_details)
-        else:
-            logger.error("TRADE FAILED")
-
-    current_portfolio["cash"] += net_cash
+        # A cancelled order can still have filled in part before the cancel went through
+        filled = Quantity.of(order_details.get("filledQuantity", 0))
+        if filled:
+            current_portfolio.apply_fill(symbol, order_details["orderLegCollection"][0]["instruction"], filled,
+                                         get_excecuted_order_value(order_details))
+
+        if order_details["status"] != "FILLED":
+            logger.error(f"TRADE FAILED: order {order_details['orderId']} for {symbol} is {order_details['status']} "
+                         f"with {filled} filled")
+            if order_details["status"] not in TERMINAL_ORDER_STATUSES:
+                unresolved.add(symbol)
 
     logger.info(f"New portfolio: {current_portfolio}")
 
-    store_portfolio(current_portfolio)
+    with metrics.timed("phase.store", phase=True):
+        buffer_portfolio(current_portfolio.to_item())
 
     day_trades_left = 3 - account_info["securitiesAccount"]["roundTrips"]
 
     logger.info(f"Day trades left: {day_trades_left}")
 
-    for symbol in current_portfolio["positions"]:
-        quantity = current_portfolio["positions"][symbol]
+    stop_orders = []
+    for symbol, position in current_portfolio.positions.items():
+        quantity = position.quantity
+
+        if symbol in unresolved:
+            logger.error(f"Not placing a trailing stop for {symbol}, it still has an open order")
+            continue
 
         if int(quantity) > 0 and (symbol not in buy_positions.keys() or (symbol in buy_positions.keys() and day_trades_left > 0)):
-            place_trailing_stop_order(account_hash, symbol, int(quantity), TRAILING_STOP_PERCENTAGE, "SELL")
+            stop_orders.append((symbol, partial(place_trailing_stop_order, account_hash, symbol, int(quantity),
+                                                TRAILING_STOP_PERCENTAGE, "SELL")))
 
             if symbol in buy_positions.keys():
                 day_trades_left -= 1
 
+    with metrics.timed("phase.stops", phase=True):
+        _, failures = submit_orders("TRAILING_STOP", stop_orders)
+        order_failures.extend(failures)
+
+    if order_failures:
+        raise OrderSubmissionError(account_hash, order_failures)
+
+
+def start_quote_streamer(symbols):
+    # Imported here so runs that don't stream never load the websocket client
+    import streamer
+
+    if not streamer.STREAM_QUOTES:
+        return None
+
+    quote_streamer = streamer.QuoteStreamer().start(symbols)
+    if not quote_streamer.wait_connected(streamer.CONNECT_TIMEOUT):
+        logger.warning("Quote streamer not connected yet, requesting quotes until it is")
+    quote_service.streamer = quote_streamer
+    return quote_streamer
+
+
 def run():
     logger.info(f"Starting bot")
 
-    desired_stocks = create_strategy()
+    import strategy
 
-    logger.info(f"Desired stocks: {desired_stocks}")
+    portfolios = [Portfolio.from_item(portfolio) for portfolio in get_all_portfolios()]
 
-    portfolios = get_all_portfolios()
+    exceptions = []
+
+    # A portfolio naming a strategy that doesn't exist is reported, the others still trade
+    runnable = []
+    for portfolio in portfolios:
+        if strategy_name(portfolio) in strategy.STRATEGIES:
+            runnable.append(portfolio)
+        else:
+            logger.error(f"Unknown strategy {strategy_name(portfolio)} for account {portfolio.account_hash}")
+            exceptions.append(Exception(f"Unknown strategy {strategy_name(portfolio)}"))
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = [executor.submit(run_for_portfolio, portfolio, desired_stocks) for portfolio in portfolios]
+    with metrics.timed("phase.strategy", phase=True):
+        desired_stocks = create_strategies(sorted({strategy_name(portfolio) for portfolio in runnable}))
 
-        exceptions = []
+    logger.info(f"Desired stocks: {desired_stocks}")
 
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                future.result()
-            except Exception as exc:
-                exceptions.append(exc)
-                traceback.print_tb(exc.__traceback__)
+    # Every portfolio prices the symbols its strategy picked, fetched once here for all of them. Held symbols outside
+    # that set are fetched by the first portfolio that needs them and shared from then on.
+    desired_symbols = sorted({symbol for stocks in desired_stocks.values() for symbol in stocks})
+    quote_streamer = start_quote_streamer(desired_symbols)
+    quote_service.prefetch(desired_symbols)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=POOL_SIZE) as executor:
+            futures = [executor.submit(run_for_portfolio, portfolio, desired_stocks[strategy_name(portfolio)])
+                       for portfolio in runnable]
+
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as exc:
+                    exceptions.append(exc)
+                    traceback.print_tb(exc.__traceback__)
+    finally:
+        # Updates are buffered by the worker threads and written in batches, whatever is left goes out here
+        with metrics.timed("phase.flush_portfolios", phase=True):
+            flush_portfolios()
+
+        if quote_streamer is not None:
+            quote_service.streamer = None
+            quote_streamer.stop()
 
     if exceptions:
         raise Exception("Errors occurred in one or more threads")
 
 
+def cancel_orders_for_portfolio(account_hash):
+    with metrics.portfolio_context(account_hash), metrics.timed("phase.cancel", phase=True):
+        return cancel_outstanding_orders(account_hash)
+
+
 def cancel_orders():
     logger.info(f"Cancelling all orders")
 
     portfolios = get_all_portfolios()
 
-    for portfolio in portfolios:
+    summary = {"accounts": len(portfolios), "cancelled": {}, "errors": {}}
 
-        account_hash = portfolio["accountHash"]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=POOL_SIZE) as executor:
+        futures = {executor.submit(cancel_orders_for_portfolio, portfolio["accountHash"]): portfolio["accountHash"]
+                   for portfolio in portfolios}
 
-        cancel_outstanding_orders(account_hash)
+        for future in concurrent.futures.as_completed(futures):
+            account_hash = futures[future]
+            try:
+                summary["cancelled"][account_hash] = future.result()
+            except Exception as exc:
+                summary["errors"][account_hash] = str(exc)
+                traceback.print_tb(exc.__traceback__)
+
+    summary["total_cancelled"] = sum(len(order_ids) for order_ids in summary["cancelled"].values())
+
+    logger.info(f"Cancel summary: {summary}")
+
+    if summary["errors"]:
+        raise Exception(f"Errors occurred in one or more threads: {summary['errors']}")
+
+    return summary
 
 
 def request_handler(event, lambda_context):
     logger.info(f"Event: {event}")
     logger.info(f"Lambda context: {lambda_context} ")
 
+    metrics.reset()
+
     try:
         run()
 
@@ -504,16 +408,22 @@ def request_handler(event, lambda_context):
 
         return response
 
+    finally:
+        metrics.flush()
+
 
 def cancel_orders_handler(event, lambda_context):
     logger.info(f"Event: {event}")
     logger.info(f"Lambda context: {lambda_context} ")
 
+    metrics.reset()
+
     try:
-        cancel_orders()
+        summary = cancel_orders()
 
         response = {
             "statusCode": 200,
+            "summary": summary,
         }
 
         return response
@@ -528,3 +438,6 @@ def cancel_orders_handler(event, lambda_context):
         }
 
         return response
+
+    finally:
+        metrics.flush()
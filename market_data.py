@@ -0,0 +1,49 @@
+import concurrent.futures
+import logging
+
+import candle_cache
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+# Maximum number of price history requests in flight at once
+MAX_CONCURRENT_REQUESTS = 8
+
+
+class PriceHistoryError(Exception):
+    def __init__(self, errors: dict[str, Exception]):
+        self.errors = errors
+        details = ", ".join(f"{symbol}: {error}" for symbol, error in errors.items())
+        super().__init__(f"Failed to fetch price history for {len(errors)} symbol(s): {details}")
+
+
+def _fetch_all(symbols: list[str], fetch, max_workers: int):
+    # Preserve the caller's order while dropping duplicates
+    symbols = list(dict.fromkeys(symbols))
+
+    if len(symbols) == 0:
+        return {}
+
+    data = {}
+    errors = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(symbols))) as executor:
+        futures = {executor.submit(fetch, symbol): symbol for symbol in symbols}
+
+        for future in concurrent.futures.as_completed(futures):
+            symbol = futures[future]
+            try:
+                data[symbol] = future.result()
+            except Exception as exc:
+                logger.error(f"Failed to fetch price history for {symbol}: {exc}")
+                errors[symbol] = exc
+
+    if errors:
+        raise PriceHistoryError(errors)
+
+    return {symbol: data[symbol] for symbol in symbols}
+
+
+def get_price_series(symbols: list[str], max_workers: int = MAX_CONCURRENT_REQUESTS):
+    # Served from the on-disk candle cache, which only asks Schwab for bars it hasn't stored yet
+    return _fetch_all(symbols, candle_cache.get_price_series, max_workers)
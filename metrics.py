@@ -0,0 +1,153 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+NAMESPACE = os.environ.get("METRICS_NAMESPACE", "AlgoTrading")
+
+# CloudWatch accepts at most 100 values per metric in a single embedded metric format line
+MAX_VALUES_PER_LINE = 100
+
+# The portfolio being processed on the current thread, attached as a dimension to everything recorded under it
+portfolio = contextvars.ContextVar("portfolio", default=None)
+_operation = contextvars.ContextVar("operation", default=None)
+
+_lock = threading.Lock()
+_run_started = time.time()
+_stats = defaultdict(lambda: {"latencies": [], "errors": 0, "retries": 0})
+_timeline = []
+
+
+def reset():
+    global _run_started
+    with _lock:
+        _run_started = time.time()
+        _stats.clear()
+        _timeline.clear()
+
+
+@contextmanager
+def portfolio_context(account_hash: str):
+    token = portfolio.set(account_hash)
+    try:
+        yield
+    finally:
+        portfolio.reset(token)
+
+
+@contextmanager
+def timed(name: str, phase: bool = False):
+    # Works as a decorator too. Records the latency of the block and whether it raised, keyed by the operation name
+    # and the current portfolio. Phases also go on the run timeline.
+    key = (name, portfolio.get())
+    token = _operation.set(key)
+    started = time.time()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        _operation.reset(token)
+        elapsed = time.time() - started
+        with _lock:
+            stats = _stats[key]
+            stats["latencies"].append(elapsed * 1000)
+            if failed:
+                stats["errors"] += 1
+            if phase:
+                _timeline.append((name, key[1], started - _run_started, elapsed, failed))
+
+
+def record_retry():
+    key = _operation.get()
+    if key is None:
+        return
+    with _lock:
+        _stats[key]["retries"] += 1
+
+
+def _emf_lines(timestamp):
+    with _lock:
+        stats = {key: dict(value, latencies=list(value["latencies"])) for key, value in _stats.items()}
+
+    for (name, account_hash), values in stats.items():
+        dimensions = [["Operation"]]
+        properties = {"Operation": name}
+        if account_hash is not None:
+            dimensions.append(["Operation", "Portfolio"])
+            properties["Portfolio"] = account_hash
+
+        latencies = values["latencies"]
+        for offset in range(0, max(len(latencies), 1), MAX_VALUES_PER_LINE):
+            first = offset == 0
+            line = {
+                "_aws": {
+                    "Timestamp": timestamp,
+                    "CloudWatchMetrics": [{
+                        "Namespace": NAMESPACE,
+                        "Dimensions": dimensions,
+                        "Metrics": [
+                            {"Name": "Latency", "Unit": "Milliseconds"},
+                            {"Name": "Calls", "Unit": "Count"},
+                            {"Name": "Errors", "Unit": "Count"},
+                            {"Name": "Retries", "Unit": "Count"},
+                        ],
+                    }],
+                },
+                **properties,
+                "Latency": latencies[offset:offset + MAX_VALUES_PER_LINE],
+                # Counts are only reported once per operation even when its latencies span several lines
+                "Calls": len(latencies) if first else 0,
+                "Errors": values["errors"] if first else 0,
+                "Retries": values["retries"] if first else 0,
+            }
+            yield json.dumps(line)
+
+
+def timeline_summary():
+    with _lock:
+        timeline = list(_timeline)
+        wall_time = time.time() - _run_started
+
+    phases = defaultdict(list)
+    per_portfolio = defaultdict(float)
+    for name, account_hash, _, elapsed, _ in timeline:
+        phases[name].append(elapsed)
+        if account_hash is not None:
+            per_portfolio[account_hash] += elapsed
+
+    summary = {"wall_time": round(wall_time, 3), "phases": {}}
+    for name, durations in phases.items():
+        durations.sort()
+        summary["phases"][name] = {
+            "count": len(durations),
+            "total": round(sum(durations), 3),
+            "p50": round(durations[len(durations) // 2], 3),
+            "max": round(durations[-1], 3),
+            "first_start": round(min(start for phase, _, start, _, _ in timeline if phase == name), 3),
+            "last_end": round(max(start + elapsed for phase, _, start, elapsed, _ in timeline if phase == name), 3),
+        }
+
+    slowest = sorted(per_portfolio.items(), key=lambda item: item[1], reverse=True)[:5]
+    summary["slowest_portfolios"] = [{"portfolio": account_hash, "seconds": round(seconds, 3)}
+                                     for account_hash, seconds in slowest]
+
+    return summary
+
+
+def flush():
+    # Embedded metric format lines are picked up from the Lambda log stream, so printing them is all it takes
+    timestamp = int(time.time() * 1000)
+    for line in _emf_lines(timestamp):
+        print(line)
+
+    logger.info(f"Run timeline: {json.dumps(timeline_summary())}")
@@ -0,0 +1,195 @@
+from decimal import Decimal
+from fractions import Fraction
+
+# Amounts and share counts are held as integers in millionths. Schwab quotes prices to at most four places, so
+# anything the broker sends is represented exactly and adding, subtracting and comparing never round.
+MICROS = 1_000_000
+
+# A float below this many units converts to micros exactly by rounding value * MICROS, the rounding error of the
+# product stays far under half a micro. Larger values go through their decimal representation instead.
+_FAST_LIMIT = 1_000_000_000
+
+
+def _round_half_even(numerator: int, denominator: int):
+    quotient, remainder = divmod(numerator, denominator)
+    twice = 2 * remainder
+    if twice > denominator or (twice == denominator and quotient % 2 == 1):
+        quotient += 1
+    return quotient
+
+
+def _micros(value):
+    if isinstance(value, int):
+        return value * MICROS
+    if isinstance(value, float):
+        if -_FAST_LIMIT < value < _FAST_LIMIT:
+            return round(value * MICROS)
+        value = Decimal(repr(value))
+    if isinstance(value, str):
+        value = Decimal(value)
+    numerator, denominator = value.as_integer_ratio()
+    return _round_half_even(numerator * MICROS, denominator)
+
+
+class FixedPoint:
+    __slots__ = ("micros",)
+
+    def __init__(self, micros: int = 0):
+        self.micros = micros
+
+    @classmethod
+    def of(cls, value):
+        # From whatever the broker or DynamoDB hands over: float, int, str or Decimal. Floats come first, every quote
+        # and balance from Schwab is one.
+        if type(value) is float and -_FAST_LIMIT < value < _FAST_LIMIT:
+            return cls(round(value * MICROS))
+        if isinstance(value, cls):
+            return value
+        return cls(_micros(value))
+
+    def to_decimal(self):
+        # DynamoDB only stores numbers as Decimal
+        value = Decimal(self.micros).scaleb(-6)
+        return value.quantize(Decimal(1)) if self.micros % MICROS == 0 else value.normalize()
+
+    def _other(self, other):
+        if type(other) is type(self):
+            return other.micros
+        if type(other) is int:
+            return other * MICROS
+        return NotImplemented
+
+    def __add__(self, other):
+        if type(other) is type(self):
+            return type(self)(self.micros + other.micros)
+        micros = self._other(other)
+        if micros is NotImplemented:
+            return NotImplemented
+        return type(self)(self.micros + micros)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if type(other) is type(self):
+            return type(self)(self.micros - other.micros)
+        micros = self._other(other)
+        if micros is NotImplemented:
+            return NotImplemented
+        return type(self)(self.micros - micros)
+
+    def __rsub__(self, other):
+        micros = self._other(other)
+        if micros is NotImplemented:
+            return NotImplemented
+        return type(self)(micros - self.micros)
+
+    def __neg__(self):
+        return type(self)(-self.micros)
+
+    def __mul__(self, other):
+        # Scaling by a plain number, e.g. a share of the portfolio
+        if isinstance(other, int):
+            return type(self)(self.micros * other)
+        if isinstance(other, (Decimal, Fraction)):
+            numerator, denominator = other.as_integer_ratio()
+            return type(self)(_round_half_even(self.micros * numerator, denominator))
+        return NotImplemented
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        if isinstance(other, int):
+            return type(self)(_round_half_even(self.micros, other))
+        return NotImplemented
+
+    def __floordiv__(self, other):
+        # How many whole times other fits, e.g. shares affordable for an amount
+        if type(other) is type(self):
+            return self.micros // other.micros
+        return NotImplemented
+
+    def __int__(self):
+        # Truncates toward zero like int(Decimal) did
+        whole = abs(self.micros) // MICROS
+        return whole if self.micros >= 0 else -whole
+
+    def __bool__(self):
+        return self.micros != 0
+
+    def __eq__(self, other):
+        if type(other) is type(self):
+            return self.micros == other.micros
+        if type(other) is int:
+            return self.micros == other * MICROS
+        return NotImplemented
+
+    def __ne__(self, other):
+        if type(other) is type(self):
+            return self.micros != other.micros
+        if type(other) is int:
+            return self.micros != other * MICROS
+        return NotImplemented
+
+    def __lt__(self, other):
+        if type(other) is type(self):
+            return self.micros < other.micros
+        if type(other) is int:
+            return self.micros < other * MICROS
+        return NotImplemented
+
+    def __le__(self, other):
+        if type(other) is type(self):
+            return self.micros <= other.micros
+        if type(other) is int:
+            return self.micros <= other * MICROS
+        return NotImplemented
+
+    def __gt__(self, other):
+        if type(other) is type(self):
+            return self.micros > other.micros
+        if type(other) is int:
+            return self.micros > other * MICROS
+        return NotImplemented
+
+    def __ge__(self, other):
+        if type(other) is type(self):
+            return self.micros >= other.micros
+        if type(other) is int:
+            return self.micros >= other * MICROS
+        return NotImplemented
+
+    def __hash__(self):
+        # Equal to an int of the same value, so it has to hash like one
+        return hash(Fraction(self.micros, MICROS))
+
+    def __str__(self):
+        return str(self.to_decimal())
+
+    def __repr__(self):
+        return f"{type(self).__name__}('{self}')"
+
+
+class Money(FixedPoint):
+    # A dollar amount
+    __slots__ = ()
+
+    def __mul__(self, other):
+        if type(other) is Quantity:
+            # Whole share counts, the usual case, never need rounding
+            product, remainder = divmod(self.micros * other.micros, MICROS)
+            return Money(product if remainder == 0 else _round_half_even(self.micros * other.micros, MICROS))
+        return FixedPoint.__mul__(self, other)
+
+    __rmul__ = __mul__
+
+
+class Quantity(FixedPoint):
+    # A number of shares
+    __slots__ = ()
+
+    def __mul__(self, other):
+        if type(other) is Money:
+            return other * self
+        return FixedPoint.__mul__(self, other)
+
+    __rmul__ = __mul__
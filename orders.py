@@ -0,0 +1,176 @@
+import concurrent.futures
+import contextvars
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable
+
+from schwab import POOL_SIZE, PRIORITY_CANCELS, cancel_order, format_time_schwab, get_order, get_orders
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+TERMINAL_ORDER_STATUSES = {"FILLED", "REJECTED", "CANCELED", "EXPIRED", "REPLACED"}
+
+# How far back to look for orders that are still open
+OPEN_ORDER_LOOKBACK = timedelta(days=2)
+
+# Polling starts fast and backs off while nothing changes, resetting as soon as any order moves
+INITIAL_POLL_INTERVAL = 0.25
+MAX_POLL_INTERVAL = 2.0
+POLL_BACKOFF = 1.5
+
+# Seconds an order may stay open before it is cancelled
+ORDER_DEADLINE = 120
+
+# Seconds to wait for an order cancelled at the deadline to reach a terminal status
+CANCEL_SETTLE_DEADLINE = 10
+
+# Shared by every portfolio thread so the number of order requests in flight never exceeds the connection pool
+_submission_executor = concurrent.futures.ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="orders")
+
+
+class OrderCancellationError(Exception):
+    def __init__(self, account_hash: str, failures: dict[str, Exception]):
+        self.account_hash = account_hash
+        self.failures = failures
+        details = ", ".join(f"{order_id}: {error}" for order_id, error in failures.items())
+        super().__init__(f"{len(failures)} order(s) could not be cancelled in account {account_hash}: {details}")
+
+
+class OrderSubmissionError(Exception):
+    def __init__(self, account_hash: str, failures: list[tuple[str, str, Exception]]):
+        self.account_hash = account_hash
+        self.failures = failures
+        details = ", ".join(f"{stage} {symbol}: {error}" for stage, symbol, error in failures)
+        super().__init__(f"{len(failures)} order(s) failed in account {account_hash}: {details}")
+
+
+def submit_orders(stage: str, orders: list[tuple[str, Callable[[], str]]]):
+    # Places every order of a stage at once. orders holds (symbol, function placing the order and returning its id).
+    # Returns the (symbol, order id) pairs that were placed and the (stage, symbol, exception) of those that weren't,
+    # a failure never stops the rest of the batch.
+    # Run each placement in a copy of the caller's context so metrics keep the portfolio dimension
+    futures = [(symbol, _submission_executor.submit(contextvars.copy_context().run, place)) for symbol, place in orders]
+
+    placed = []
+    failures = []
+    for symbol, future in futures:
+        try:
+            order_id = future.result()
+            logger.info(f"Placed {stage} order {order_id} for {symbol}")
+            placed.append((symbol, order_id))
+        except Exception as exc:
+            logger.error(f"Failed to place {stage} order for {symbol}: {exc}")
+            failures.append((stage, symbol, exc))
+
+    return placed, failures
+
+
+def track_orders(account_hash: str, orders: list[tuple[str, str]], deadline: float = ORDER_DEADLINE):
+    # Yields (symbol, order details) for each order as soon as it reaches a terminal status. One get_orders call per
+    # poll covers every outstanding order in the account. Orders still open at the deadline are cancelled and
+    # yielded as they stand once the cancel settles.
+    started = time.monotonic()
+    pending = {str(order_id): symbol for symbol, order_id in orders}
+    last_seen = {}
+
+    # Every tracked order was entered after this, the margin covers clock skew with Schwab
+    from_time = format_time_schwab(datetime.now(timezone.utc) - timedelta(minutes=5))
+
+    interval = INITIAL_POLL_INTERVAL
+
+    while pending:
+        time.sleep(interval)
+
+        to_time = format_time_schwab(datetime.now(timezone.utc) + timedelta(minutes=1))
+
+        changed = False
+        for order_details in get_orders(account_hash, from_time, to_time):
+            order_id = str(order_details["orderId"])
+            if order_id not in pending:
+                continue
+
+            previous = last_seen.get(order_id)
+            last_seen[order_id] = order_details
+
+            if order_details["status"] in TERMINAL_ORDER_STATUSES:
+                symbol = pending.pop(order_id)
+                logger.info(f"Order {order_id} for {symbol} finished as {order_details['status']}")
+                changed = True
+                yield symbol, order_details
+            elif previous is None or previous["status"] != order_details["status"]:
+                logger.info(f"Order {order_id} is {order_details['status']}")
+                changed = True
+
+        if pending and time.monotonic() - started > deadline:
+            # Left working, a sell would keep its shares tied up under the trailing stop placed next and the buys
+            # would spend cash it never released
+            for order_id, symbol in list(pending.items()):
+                del pending[order_id]
+                yield symbol, _cancel_overdue(account_hash, order_id, symbol, deadline)
+
+        interval = INITIAL_POLL_INTERVAL if changed else min(interval * POLL_BACKOFF, MAX_POLL_INTERVAL)
+
+
+def _cancel_overdue(account_hash: str, order_id: str, symbol: str, deadline: float):
+    logger.error(f"Order {order_id} for {symbol} still open after {deadline}s, cancelling it")
+    try:
+        cancel_order(account_hash, order_id)
+    except Exception as exc:
+        # It may have filled since the last poll, the order read below says what happened
+        logger.error(f"Failed to cancel order {order_id}: {exc}")
+
+    # Read back until the cancel settles, anything filled before it still has to be accounted for
+    settle_by = time.monotonic() + CANCEL_SETTLE_DEADLINE
+    interval = INITIAL_POLL_INTERVAL
+    while True:
+        order_details = get_order(account_hash, order_id)
+        if order_details["status"] in TERMINAL_ORDER_STATUSES or time.monotonic() > settle_by:
+            logger.info(f"Order {order_id} for {symbol} finished as {order_details['status']}")
+            return order_details
+        time.sleep(interval)
+        interval = min(interval * POLL_BACKOFF, MAX_POLL_INTERVAL)
+
+
+def get_open_orders(account_hash: str):
+    now = datetime.now(timezone.utc)
+
+    from_time = format_time_schwab(now - OPEN_ORDER_LOOKBACK)
+    to_time = format_time_schwab(now)
+
+    # One unfiltered listing, filtered here on Schwab's own cancelable flag. Asking per status would take a request
+    # for each of the many statuses an order can be cancelled in (ACCEPTED, AWAITING_CONDITION, AWAITING_MANUAL_REVIEW
+    # and so on) out of the shared rate budget, and any status left off the list would leave its orders working
+    # under the next run's trailing stops. The price is a larger response that includes the filled and cancelled
+    # orders of the lookback window.
+    # Finding open orders is part of cancelling them, so it queues with the cancels rather than the status polling
+    orders = get_orders(account_hash, from_time, to_time, priority=PRIORITY_CANCELS)
+
+    return [order for order in orders if order["cancelable"]]
+
+
+def cancel_open_orders(account_hash: str):
+    # Cancels every cancelable open order in the account at once and returns the ids that were cancelled
+    orders = get_open_orders(account_hash)
+
+    futures = [(str(order["orderId"]),
+                _submission_executor.submit(contextvars.copy_context().run, cancel_order, account_hash,
+                                            order["orderId"]))
+               for order in orders]
+
+    cancelled = []
+    failures = {}
+    for order_id, future in futures:
+        try:
+            future.result()
+            logger.info(f"Order {order_id} has been canceled")
+            cancelled.append(order_id)
+        except Exception as exc:
+            logger.error(f"Failed to cancel order {order_id}: {exc}")
+            failures[order_id] = exc
+
+    if failures:
+        raise OrderCancellationError(account_hash, failures)
+
+    return cancelled
@@ -0,0 +1,11 @@
+from typing import NamedTuple
+
+
+class Parameters(NamedTuple):
+    # The tunable numbers of the default_strategy decision tree, the defaults are what the bot trades with
+    risk_on_return_days: int = 60
+    rates_return_days: int = 20
+    risk_on_rsi_days: int = 10
+    rising_rates_rsi_days: int = 20
+    risk_on_picks: int = 2
+    trailing_stop_percentage: float = 4.75
@@ -0,0 +1,76 @@
+from money import MICROS, Money, Quantity
+
+
+class Position:
+    __slots__ = ("symbol", "quantity")
+
+    def __init__(self, symbol: str, quantity: Quantity):
+        self.symbol = symbol
+        self.quantity = quantity
+
+    def __repr__(self):
+        return f"Position({self.symbol}, {self.quantity})"
+
+
+class Portfolio:
+    # One account as the bot tracks it. Attributes of the stored item that the bot doesn't interpret are carried
+    # through untouched so writing the portfolio back never drops them.
+    __slots__ = ("account_hash", "cash", "positions", "attributes")
+
+    def __init__(self, account_hash: str, cash: Money = Money(0), positions: dict[str, Position] = None,
+                 attributes: dict = None):
+        self.account_hash = account_hash
+        self.cash = cash
+        self.positions = positions if positions is not None else {}
+        self.attributes = attributes if attributes is not None else {}
+
+    @classmethod
+    def from_item(cls, item: dict):
+        attributes = dict(item)
+        account_hash = attributes.pop("accountHash")
+        cash = Money.of(attributes.pop("cash", 0))
+        positions = {symbol: Position(symbol, Quantity.of(quantity))
+                     for symbol, quantity in attributes.pop("positions", {}).items()}
+        return cls(account_hash, cash, positions, attributes)
+
+    def to_item(self):
+        return {
+            **self.attributes,
+            "accountHash": self.account_hash,
+            "cash": self.cash.to_decimal(),
+            "positions": {symbol: position.quantity.to_decimal() for symbol, position in self.positions.items()},
+        }
+
+    def update_from_account(self, account_info: dict):
+        # Replaces cash and positions with what Schwab reports for the account
+        securities_account = account_info["securitiesAccount"]
+        self.cash = Money.of(securities_account["currentBalances"]["availableFunds"])
+        self.positions = {}
+        for position in securities_account.get("positions", ()):
+            symbol = position["instrument"]["symbol"]
+            self.positions[symbol] = Position(symbol, Quantity.of(position["longQuantity"]))
+
+    def quantities(self):
+        return {symbol: position.quantity for symbol, position in self.positions.items()}
+
+    def value(self, prices: dict[str, Money]):
+        # Summed in micro-units squared and rounded once, rather than building a Money for every position
+        total = self.cash.micros * MICROS
+        for symbol, position in self.positions.items():
+            total += prices[symbol].micros * position.quantity.micros
+        return Money(total // MICROS)
+
+    def apply_fill(self, symbol: str, instruction: str, quantity: Quantity, value: Money):
+        position = self.positions.get(symbol)
+        if position is None:
+            position = self.positions[symbol] = Position(symbol, Quantity(0))
+
+        if instruction == "SELL":
+            position.quantity -= quantity
+            self.cash += value
+        else:
+            position.quantity += quantity
+            self.cash -= value
+
+    def __repr__(self):
+        return f"Portfolio({self.account_hash}, cash={self.cash}, positions={self.quantities()})"
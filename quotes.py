@@ -0,0 +1,131 @@
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+
+from money import Money
+from schwab import get_current_quotes, quotes_url
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+# Seconds a quote is served to every portfolio before it is fetched again
+QUOTE_MAX_AGE = float(os.environ.get("QUOTE_MAX_AGE", "10"))
+
+# Longest quotes URL sent in one request, symbols beyond it go in another batch
+QUOTE_URL_LIMIT = int(os.environ.get("QUOTE_URL_LIMIT", "2000"))
+
+# Maximum number of quote batches in flight at once
+MAX_CONCURRENT_BATCHES = 4
+
+
+class Quote:
+    # One symbol's quote, converted to Money once when it arrives instead of by every portfolio that reads it
+    __slots__ = ("symbol", "ask", "bid", "last", "realtime", "fetched_at")
+
+    def __init__(self, symbol: str, ask: Money, bid: Money, last: Money, realtime: bool, fetched_at: float):
+        self.symbol = symbol
+        self.ask = ask
+        self.bid = bid
+        self.last = last
+        self.realtime = realtime
+        self.fetched_at = fetched_at
+
+    @classmethod
+    def from_response(cls, symbol: str, information: dict, fetched_at: float):
+        quote = information["quote"]
+        return cls(symbol, Money.of(quote["askPrice"]), Money.of(quote["bidPrice"]), Money.of(quote["lastPrice"]),
+                   information["realtime"], fetched_at)
+
+    def __repr__(self):
+        return f"Quote({self.symbol}, ask={self.ask}, bid={self.bid}, last={self.last})"
+
+
+def batches(symbols: list[str], url_limit: int = QUOTE_URL_LIMIT):
+    # As few groups as the URL limit allows, each symbol costs its length plus a comma
+    groups = []
+    group = []
+    length = len(quotes_url([]))
+    for symbol in symbols:
+        added = len(symbol) + (1 if group else 0)
+        if group and length + added > url_limit:
+            groups.append(group)
+            group = []
+            length = len(quotes_url([]))
+            added = len(symbol)
+        group.append(symbol)
+        length += added
+    if group:
+        groups.append(group)
+    return groups
+
+
+class QuoteService:
+    # Quotes shared by every portfolio thread in a run. A symbol is fetched once and served from memory until it is
+    # older than max_age, and whatever is missing is fetched together in URL sized batches.
+
+    def __init__(self, max_age: float = QUOTE_MAX_AGE):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+        # None marks a symbol Schwab returned no quote for, so it isn't asked for again until it goes stale
+        self._quotes = {}
+        self._checked_at = {}
+        # A connected streamer is asked first, the symbols it is pushing never need a request
+        self.streamer = None
+
+    def _streamed(self, symbol):
+        streamer = self.streamer
+        return streamer.quote(symbol) if streamer is not None else None
+
+    def _stale(self, symbols, now):
+        with self._lock:
+            return [symbol for symbol in symbols
+                    if symbol not in self._checked_at or now - self._checked_at[symbol] >= self.max_age]
+
+    def _fetch(self, symbols):
+        groups = batches(symbols)
+        logger.info(f"Fetching quotes for {len(symbols)} symbol(s) in {len(groups)} request(s)")
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_BATCHES, len(groups))) as executor:
+            responses = list(executor.map(get_current_quotes, groups))
+
+        fetched_at = time.monotonic()
+        received = {}
+        for response in responses:
+            for symbol, information in response.items():
+                received[symbol] = Quote.from_response(symbol, information, fetched_at)
+
+        with self._lock:
+            for symbol in symbols:
+                self._quotes[symbol] = received.get(symbol)
+                self._checked_at[symbol] = fetched_at
+
+    def prefetch(self, symbols):
+        symbols = [symbol for symbol in dict.fromkeys(symbols) if self._streamed(symbol) is None]
+        if not self._stale(symbols, time.monotonic()):
+            return
+
+        # One thread fetches, the others wait and then find what it fetched
+        with self._fetch_lock:
+            stale = self._stale(symbols, time.monotonic())
+            if stale:
+                self._fetch(stale)
+
+    def get(self, symbol: str):
+        streamed = self._streamed(symbol)
+        if streamed is not None:
+            return streamed
+
+        self.prefetch([symbol])
+        with self._lock:
+            return self._quotes.get(symbol)
+
+    def clear(self):
+        with self._lock:
+            self._quotes.clear()
+            self._checked_at.clear()
+
+
+quote_service = QuoteService()
@@ -1,20 +1,189 @@
 import json
 import base64
+import heapq
+import itertools
 import logging
 import time
 import os
+import random
+import threading
+from collections import deque
 import requests
+from requests.adapters import HTTPAdapter
+import metrics
 from ssm import get_secret, put_secret
 from datetime import datetime, timedelta, timezone
 
 logger = logging.getLogger()
 logger.setLevel("INFO")
 
-BASE_URL = "https://api.schwabapi.com"
+BASE_URL = os.environ.get("SCHWAB_BASE_URL", "https://api.schwabapi.com")
 REDIRECT_URI = 'https://schwab.jonathandamico.me/callback'
-REFRESH_TOKEN = None
-ACCESS_TOKEN = None
-TOKEN_EXPIRY = None
+REFRESH_TOKEN_PARAMETER = "/algotrading/schwab/refreshtoken"
+ACCESS_TOKEN_PARAMETER = "/algotrading/schwab/accesstoken"
+
+# Refresh the access token this many seconds before Schwab would expire it
+TOKEN_EXPIRY_MARGIN = 60
+
+# Shared transport settings. The pool is sized to the portfolio thread pool in main.run so every worker can hold a
+# connection without waiting on another.
+POOL_SIZE = int(os.environ.get("SCHWAB_POOL_SIZE", "16"))
+CONNECT_TIMEOUT = float(os.environ.get("SCHWAB_CONNECT_TIMEOUT", "3.05"))
+READ_TIMEOUT = float(os.environ.get("SCHWAB_READ_TIMEOUT", "15"))
+MAX_RETRIES = int(os.environ.get("SCHWAB_MAX_RETRIES", "3"))
+RETRY_BACKOFF = float(os.environ.get("SCHWAB_RETRY_BACKOFF", "0.25"))
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Schwab counts every call the app makes, so every thread shares one budget of RATE_LIMIT requests per RATE_WINDOW
+# seconds
+RATE_LIMIT = int(os.environ.get("SCHWAB_RATE_LIMIT", "120"))
+RATE_WINDOW = float(os.environ.get("SCHWAB_RATE_WINDOW", "60"))
+
+# When requests queue for the budget the lowest number goes first
+PRIORITY_ORDERS = 0
+PRIORITY_CANCELS = 1
+PRIORITY_QUOTES = 2
+PRIORITY_STATUS = 3
+
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, pool_block=True)
+_session.mount("https://", _adapter)
+_session.mount("http://", _adapter)
+
+
+class RateGovernor:
+    # Sliding window limiter shared by every thread. Waiting requests are released in priority order, so order status
+    # polling can never hold up an order being placed. A 429 pauses everyone, not just the thread that got it.
+
+    def __init__(self, limit: int, window: float):
+        self.limit = limit
+        self.window = window
+        self._condition = threading.Condition()
+        # Send times of the requests still inside the window
+        self._sent = deque()
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._paused_until = 0.0
+        self._throttled = 0
+
+    def _delay(self, now):
+        while self._sent and self._sent[0] <= now - self.window:
+            self._sent.popleft()
+
+        delay = self._paused_until - now
+        if len(self._sent) >= self.limit:
+            delay = max(delay, self._sent[0] + self.window - now)
+        return max(delay, 0)
+
+    def acquire(self, priority: int):
+        with self._condition:
+            entry = (priority, next(self._sequence))
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = self._delay(now)
+                    if self._waiting[0] == entry:
+                        if delay == 0:
+                            heapq.heappop(self._waiting)
+                            self._sent.append(now)
+                            return
+                        self._condition.wait(delay)
+                    else:
+                        self._condition.wait()
+            finally:
+                if entry in self._waiting:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                # Whoever is now at the front of the queue has to re-check
+                self._condition.notify_all()
+
+    def throttled(self, retry_after: float = None):
+        # Honour Retry-After when Schwab sends it, otherwise back off further with each consecutive 429
+        with self._condition:
+            self._throttled += 1
+            delay = retry_after if retry_after is not None else \
+                min(RETRY_BACKOFF * (2 ** (self._throttled - 1)), self.window)
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            self._condition.notify_all()
+        return delay
+
+    def succeeded(self):
+        if self._throttled:
+            with self._condition:
+                self._throttled = 0
+
+
+_governor = RateGovernor(RATE_LIMIT, RATE_WINDOW)
+
+
+def _retry_after(response):
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
+
+
+def _retry_delay(attempt):
+    # Full jitter so threads that failed together don't retry together
+    return random.uniform(0, RETRY_BACKOFF * (2 ** attempt))
+
+
+def _request(method, url, priority: int = PRIORITY_QUOTES, **kwargs):
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+
+    # Only idempotent reads are retried on errors, an order POST or DELETE must never be sent twice. A 429 is the
+    # exception, Schwab rejects throttled requests before acting on them so they are safe to send again.
+    retries = MAX_RETRIES if method == "GET" else 0
+
+    attempt = 0
+    throttled = 0
+    reauthorized = False
+    while True:
+        _governor.acquire(priority)
+        try:
+            response = _session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as exc:
+            if attempt >= retries:
+                raise
+            logger.warning(f"{method} {url} failed with {exc}, retrying")
+            metrics.record_retry()
+        else:
+            access_token = _bearer_token(kwargs.get("headers"))
+            if response.status_code == 401 and access_token is not None and not reauthorized:
+                # Schwab has dropped the token, e.g. after a re-authorization, though its stored expiry is still
+                # ahead. Like a 429 it is rejected before anything is acted on, so sending it again is safe.
+                logger.warning(f"{method} {url} was unauthorized, refreshing the access token")
+                kwargs["headers"] = {**kwargs["headers"],
+                                     "Authorization": f"Bearer {_token_manager.replace(access_token)}"}
+                reauthorized = True
+                continue
+
+            if response.status_code == 429:
+                delay = _governor.throttled(_retry_after(response))
+                if throttled >= MAX_RETRIES:
+                    return response
+                logger.warning(f"{method} {url} was throttled, backing off {delay:.2f}s")
+                metrics.record_retry()
+                # The governor holds every thread back until the pause is over, no extra sleep needed
+                throttled += 1
+                continue
+
+            _governor.succeeded()
+            if response.status_code not in RETRYABLE_STATUS_CODES or attempt >= retries:
+                return response
+            logger.warning(f"{method} {url} returned {response.status_code}, retrying")
+            metrics.record_retry()
+
+        time.sleep(_retry_delay(attempt))
+        attempt += 1
+
+
+def _bearer_token(headers):
+    authorization = (headers or {}).get("Authorization", "")
+    if authorization.startswith("Bearer "):
+        return authorization[len("Bearer "):]
+    return None
 
 
 def get_app_key():
@@ -25,49 +194,117 @@ def get_app_secret():
     return get_secret("/algotrading/schwab/appsecret")
 
 
+@metrics.timed("schwab.get_token")
 def get_token(authorization_code):
     redirect_uri = f"{os.environ['API_URL']}/callback"
 
     headers = {'Authorization': f'Basic {base64.b64encode(bytes(f"{get_app_key()}:{get_app_secret()}", "utf-8")).decode("utf-8")}', 'Content-Type': 'application/x-www-form-urlencoded'}
     data = {'grant_type': 'authorization_code', 'code': authorization_code, 'redirect_uri': redirect_uri}
-    resp = requests.post('https://api.schwabapi.com/v1/oauth/token', headers=headers, data=data)
+    resp = _request("POST", f"{BASE_URL}/v1/oauth/token", PRIORITY_ORDERS, headers=headers, data=data)
 
     resp.raise_for_status()
 
     return resp.json()
 
 
+@metrics.timed("schwab.get_token_refresh")
 def get_token_refresh(refresh_token):
     headers = {'Authorization': f'Basic {base64.b64encode(bytes(f"{get_app_key()}:{get_app_secret()}", "utf-8")).decode("utf-8")}',
                'Content-Type': 'application/x-www-form-urlencoded'}
     data = {'grant_type': 'refresh_token', 'refresh_token': refresh_token}
-    resp = requests.post('https://api.schwabapi.com/v1/oauth/token', headers=headers, data=data)
+    resp = _request("POST", f"{BASE_URL}/v1/oauth/token", PRIORITY_ORDERS, headers=headers, data=data)
 
     resp.raise_for_status()
 
     return resp.json()
 
 
-def get_access_token():
-    global REFRESH_TOKEN, ACCESS_TOKEN, TOKEN_EXPIRY
+def save_tokens(token_response):
+    # Stores both tokens of a token response for every other container to pick up and returns the (access token,
+    # expiry) pair
+    access_token = token_response["access_token"]
+    expiry = time.time() + token_response["expires_in"] - TOKEN_EXPIRY_MARGIN
+
+    put_secret(REFRESH_TOKEN_PARAMETER, token_response["refresh_token"])
+    put_secret(ACCESS_TOKEN_PARAMETER, json.dumps({"access_token": access_token, "expiry": expiry}))
+
+    return access_token, expiry
+
+
+class AccessTokenManager:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._refresh_token = None
+        # (access token, expiry timestamp), swapped as a single tuple so readers never see a half updated pair
+        self._token = (None, 0)
+
+    def _valid_token(self):
+        access_token, expiry = self._token
+        if access_token is not None and time.time() < expiry:
+            return access_token
+        return None
+
+    def _load_persisted_token(self):
+        # A previous invocation may have left a token that is still good, which saves a refresh on cold start
+        try:
+            persisted = json.loads(get_secret(ACCESS_TOKEN_PARAMETER))
+            self._token = (persisted["access_token"], persisted["expiry"])
+        except Exception as exc:
+            logger.info(f"No persisted access token available: {exc}")
+
+    def _refresh(self):
+        if self._refresh_token is None:
+            self._refresh_token = get_secret(REFRESH_TOKEN_PARAMETER)
 
-    if not ACCESS_TOKEN or time.time() > TOKEN_EXPIRY:
-        if REFRESH_TOKEN is None:
-            REFRESH_TOKEN = get_secret("/algotrading/schwab/refreshtoken")
+        token_refresh_response = get_token_refresh(self._refresh_token)
 
-        token_refresh_response = get_token_refresh(REFRESH_TOKEN)
+        self._refresh_token = token_refresh_response["refresh_token"]
+        self._token = save_tokens(token_refresh_response)
 
-        ACCESS_TOKEN = token_refresh_response["access_token"]
+    def replace(self, rejected_token):
+        # Called when Schwab answers a token with 401. Only the first thread to report it refreshes, the others
+        # find it already replaced and use the new one.
+        with self._lock:
+            if self._token[0] == rejected_token:
+                # Read the refresh token again too, a re-authorization will have replaced the one held here
+                self._refresh_token = None
+                logger.info("Refreshing rejected Schwab access token")
+                self._refresh()
 
-        REFRESH_TOKEN = token_refresh_response["refresh_token"]
-        put_secret("/algotrading/schwab/refreshtoken", token_refresh_response["refresh_token"])
+            return self._token[0]
 
-        TOKEN_EXPIRY = time.time() + token_refresh_response['expires_in'] - 60
+    def get(self):
+        access_token = self._valid_token()
+        if access_token is not None:
+            return access_token
 
-    return ACCESS_TOKEN
+        # Only one thread refreshes, the rest block here and pick up its result
+        with self._lock:
+            access_token = self._valid_token()
+            if access_token is not None:
+                return access_token
+
+            if self._token[0] is None:
+                self._load_persisted_token()
+                access_token = self._valid_token()
+                if access_token is not None:
+                    return access_token
+
+            logger.info("Refreshing Schwab access token")
+            self._refresh()
+
+            return self._token[0]
+
+
+_token_manager = AccessTokenManager()
+
+
+def get_access_token():
+    return _token_manager.get()
 
 
-def get_price_history(symbol):
+@metrics.timed("schwab.get_price_history")
+def get_price_history(symbol, start_date: int = None, end_date: int = None):
     url = f"{BASE_URL}/marketdata/v1/pricehistory"
     headers = {
         'accept': 'application/json',
@@ -80,7 +317,13 @@ def get_price_history(symbol):
         'frequencyType': 'daily'
     }
 
-    response = requests.get(url, headers=headers, params=params)
+    # start_date and end_date are epoch milliseconds, when given they take precedence over the period
+    if start_date is not None:
+        params['startDate'] = start_date
+    if end_date is not None:
+        params['endDate'] = end_date
+
+    response = _request("GET", url, headers=headers, params=params)
 
     # Ensure the request was successful
     response.raise_for_status()
@@ -89,16 +332,21 @@ def get_price_history(symbol):
     return response.json()["candles"]
 
 
+def quotes_url(symbols: list[str]):
+    return f"{BASE_URL}/marketdata/v1/quotes?symbols={','.join(symbols)}&fields=quote&indicative=false"
+
+
+@metrics.timed("schwab.get_current_quotes")
 def get_current_quotes(symbols: list[str]):
     if len(symbols) == 0:
         return {}
 
-    url = f"{BASE_URL}/marketdata/v1/quotes?symbols={','.join(symbols)}&fields=quote&indicative=false"
+    url = quotes_url(symbols)
     headers = {
         'Authorization': f'Bearer {get_access_token()}'
     }
 
-    response = requests.get(url, headers=headers)
+    response = _request("GET", url, headers=headers)
 
     # Ensure the request was successful
     response.raise_for_status()
@@ -107,6 +355,7 @@ def get_current_quotes(symbols: list[str]):
     return response.json()
 
 
+@metrics.timed("schwab.get_accounts")
 def get_accounts():
     url = f"{BASE_URL}/trader/v1/accounts"
     headers = {
@@ -114,7 +363,7 @@ def get_accounts():
         'Authorization': f'Bearer {get_access_token()}'
     }
 
-    response = requests.get(url, headers=headers)
+    response = _request("GET", url, headers=headers)
 
     # Ensure the request was successful
     response.raise_for_status()
@@ -123,13 +372,30 @@ def get_accounts():
     return response.json()
 
 
+@metrics.timed("schwab.get_user_preference")
+def get_user_preference():
+    # Holds the streamer URL and the identifiers its login request needs
+    url = f"{BASE_URL}/trader/v1/userPreference"
+    headers = {
+        'accept': 'application/json',
+        'Authorization': f'Bearer {get_access_token()}'
+    }
+
+    response = _request("GET", url, headers=headers)
+
+    response.raise_for_status()
+
+    return response.json()
+
+
+@metrics.timed("schwab.get_account")
 def get_account(account_hash: str):
     url = f"{BASE_URL}/trader/v1/accounts/{account_hash}?fields=positions"
     headers = {
         'Authorization': f'Bearer {get_access_token()}'
     }
 
-    response = requests.get(url, headers=headers)
+    response = _request("GET", url, headers=headers)
 
     # Ensure the request was successful
     response.raise_for_status()
@@ -138,6 +404,7 @@ def get_account(account_hash: str):
     return response.json()
 
 
+@metrics.timed("schwab.place_limit_order")
 def place_limit_order(account_hash: str, symbol: str, quantity: int, limit_price: float, instruction: str):
     url = f"{BASE_URL}/trader/v1/accounts/{account_hash}/orders"
     headers = {
@@ -168,7 +435,7 @@ def place_limit_order(account_hash: str, symbol: str, quantity: int, limit_price
         "taxLotMethod": "LOSS_HARVESTER"
     })
 
-    response = requests.request("POST", url, headers=headers, data=payload)
+    response = _request("POST", url, PRIORITY_ORDERS, headers=headers, data=payload)
 
     if 200 <= response.status_code < 300:
         location = response.headers.get("Location")
@@ -180,6 +447,7 @@ def place_limit_order(account_hash: str, symbol: str, quantity: int, limit_price
         response.raise_for_status()
 
 
+@metrics.timed("schwab.place_market_order")
 def place_market_order(account_hash: str, symbol: str, quantity: int, instruction: str):
     url = f"{BASE_URL}/trader/v1/accounts/{account_hash}/orders"
     headers = {
@@ -209,7 +477,7 @@ def place_market_order(account_hash: str, symbol: str, quantity: int, instructio
         "taxLotMethod": "LOSS_HARVESTER"
     })
 
-    response = requests.request("POST", url, headers=headers, data=payload)
+    response = _request("POST", url, PRIORITY_ORDERS, headers=headers, data=payload)
 
     if 200 <= response.status_code < 300:
         location = response.headers.get("Location")
@@ -221,6 +489,7 @@ def place_market_order(account_hash: str, symbol: str, quantity: int, instructio
         response.raise_for_status()
 
 
+@metrics.timed("schwab.place_trailing_stop_order")
 def place_trailing_stop_order(account_hash: str, symbol: str, quantity: int, percentage: float, instruction: str):
     url = f"{BASE_URL}/trader/v1/accounts/{account_hash}/orders"
 
@@ -258,7 +527,7 @@ def place_trailing_stop_order(account_hash: str, symbol: str, quantity: int, per
         "taxLotMethod": "LOSS_HARVESTER"
     })
 
-    response = requests.request("POST", url, headers=headers, data=payload)
+    response = _request("POST", url, PRIORITY_ORDERS, headers=headers, data=payload)
 
     if 200 <= response.status_code < 300:
         location = response.headers.get("Location")
@@ -270,38 +539,45 @@ def place_trailing_stop_order(account_hash: str, symbol: str, quantity: int, per
         response.raise_for_status()
 
 
-def get_orders(account_hash: str, from_time: str, to_time: str):
+def format_time_schwab(time_obj):
+    return time_obj.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+@metrics.timed("schwab.get_orders")
+def get_orders(account_hash: str, from_time: str, to_time: str, priority: int = PRIORITY_STATUS):
     url = f"{BASE_URL}/trader/v1/accounts/{account_hash}/orders?fromEnteredTime={from_time}&toEnteredTime={to_time}"
     headers = {
         'Authorization': f'Bearer {get_access_token()}'
     }
 
-    response = requests.request("GET", url, headers=headers)
+    response = _request("GET", url, priority, headers=headers)
 
     response.raise_for_status()
 
     return response.json()
 
 
+@metrics.timed("schwab.get_order")
 def get_order(account_hash: str, order_id: int):
     url = f"{BASE_URL}/trader/v1/accounts/{account_hash}/orders/{order_id}"
     headers = {
         'Authorization': f'Bearer {get_access_token()}'
     }
 
-    response = requests.request("GET", url, headers=headers)
+    response = _request("GET", url, PRIORITY_STATUS, headers=headers)
 
     response.raise_for_status()
 
     return response.json()
 
 
+@metrics.timed("schwab.cancel_order")
 def cancel_order(account_hash: str, order_id: int):
     url = f"{BASE_URL}/trader/v1/accounts/{account_hash}/orders/{order_id}"
     headers = {
         'Authorization': f'Bearer {get_access_token()}'
     }
 
-    response = requests.request("DELETE", url, headers=headers)
+    response = _request("DELETE", url, PRIORITY_CANCELS, headers=headers)
 
     response.raise_for_status()
@@ -0,0 +1,74 @@
+import numpy as np
+
+
+def _read_only(array):
+    array.setflags(write=False)
+    return array
+
+
+class PriceSeries:
+    __slots__ = ("symbol", "dates", "open", "high", "low", "close", "volume")
+
+    def __init__(self, symbol: str, dates, open, high, low, close, volume):
+        # Arrays are shared between every indicator computed on the series, so none of them may be written to
+        object.__setattr__(self, "symbol", symbol)
+        object.__setattr__(self, "dates", _read_only(np.asarray(dates, dtype="datetime64[D]")))
+        object.__setattr__(self, "open", _read_only(np.asarray(open, dtype=np.float64)))
+        object.__setattr__(self, "high", _read_only(np.asarray(high, dtype=np.float64)))
+        object.__setattr__(self, "low", _read_only(np.asarray(low, dtype=np.float64)))
+        object.__setattr__(self, "close", _read_only(np.asarray(close, dtype=np.float64)))
+        object.__setattr__(self, "volume", _read_only(np.asarray(volume, dtype=np.int64)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PriceSeries is immutable")
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __repr__(self):
+        if len(self) == 0:
+            return f"PriceSeries({self.symbol}, empty)"
+        return f"PriceSeries({self.symbol}, {self.dates[0]} to {self.dates[-1]}, {len(self)} bars)"
+
+    @classmethod
+    def from_candles(cls, symbol: str, candles: list[dict]):
+        count = len(candles)
+
+        timestamps = np.fromiter((candle["datetime"] for candle in candles), dtype=np.int64, count=count)
+
+        # Sort once here so no indicator ever has to
+        order = np.argsort(timestamps, kind="stable")
+
+        def column(field, dtype):
+            return np.fromiter((candle[field] for candle in candles), dtype=dtype, count=count)[order]
+
+        return cls(
+            symbol,
+            timestamps[order].astype("datetime64[ms]").astype("datetime64[D]"),
+            column("open", np.float64),
+            column("high", np.float64),
+            column("low", np.float64),
+            column("close", np.float64),
+            column("volume", np.int64),
+        )
+
+    @classmethod
+    def from_records(cls, symbol: str, records):
+        # records is a structured array in candle_cache.CANDLE_DTYPE layout, already sorted by datetime
+        return cls(
+            symbol,
+            records["datetime"].astype("datetime64[ms]").astype("datetime64[D]"),
+            np.ascontiguousarray(records["open"]),
+            np.ascontiguousarray(records["high"]),
+            np.ascontiguousarray(records["low"]),
+            np.ascontiguousarray(records["close"]),
+            np.ascontiguousarray(records["volume"]),
+        )
+
+    def index_of(self, date):
+        # Index of the bar on the given date, or None when there was no bar that day
+        date = np.datetime64(date, "D")
+        index = int(np.searchsorted(self.dates, date))
+        if index < len(self.dates) and self.dates[index] == date:
+            return index
+        return None
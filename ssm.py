@@ -1,22 +1,91 @@
+import os
+import threading
+import time
+
 import boto3
 
-def get_secret(parameter_name):
-    # Create an SSM client
-    ssm = boto3.client('ssm')
+import metrics
+from lazy import Lazy
+
+# Every parameter the bot uses lives under this path, so one get_parameters_by_path call loads all of them
+SECRETS_PATH = os.environ.get("SECRETS_PATH", "/algotrading")
+
+# Seconds a loaded value is served from memory before the whole path is read again
+SECRETS_TTL = float(os.environ.get("SECRETS_TTL", "300"))
+
+# Shared by every call and every warm invocation instead of a new client per call
+ssm_client = Lazy("ssm_client", lambda: boto3.client('ssm'))
+
+
+class SecretCache:
+    def __init__(self, path: str, ttl: float):
+        self.path = path.rstrip("/")
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._values = {}
+        self._loaded_at = None
+
+    def _fresh(self):
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def _in_path(self, parameter_name):
+        return parameter_name.startswith(f"{self.path}/")
+
+    @metrics.timed("ssm.get_parameters_by_path")
+    def _load(self):
+        values = {}
+        paginator = ssm_client.get().get_paginator("get_parameters_by_path")
+        for page in paginator.paginate(Path=self.path, Recursive=True, WithDecryption=True):
+            for parameter in page["Parameters"]:
+                values[parameter["Name"]] = parameter["Value"]
+
+        self._values = values
+        self._loaded_at = time.monotonic()
+
+    def get(self, parameter_name):
+        if not self._in_path(parameter_name):
+            return _get_parameter(parameter_name)
 
+        # Only one thread reloads, the rest block here and read what it loaded
+        with self._lock:
+            if not self._fresh():
+                self._load()
+
+            if parameter_name not in self._values:
+                raise Exception(f"Parameter {parameter_name} not found in SSM")
+
+            return self._values[parameter_name]
+
+    def put(self, parameter_name, value):
+        # Written through rather than dropped, the value just stored is the one the next read must see
+        with self._lock:
+            if self._fresh() and self._in_path(parameter_name):
+                self._values[parameter_name] = value
+
+
+@metrics.timed("ssm.get_parameter")
+def _get_parameter(parameter_name):
     # Fetch the parameter
-    parameter = ssm.get_parameter(Name=parameter_name, WithDecryption=True)
+    parameter = ssm_client.get().get_parameter(Name=parameter_name, WithDecryption=True)
     return parameter['Parameter']['Value']
 
 
-def put_secret(parameter_name, new_value):
-    # Create an SSM client
-    ssm = boto3.client('ssm')
+secrets = SecretCache(SECRETS_PATH, SECRETS_TTL)
 
+
+@metrics.timed("ssm.get_secret")
+def get_secret(parameter_name):
+    return secrets.get(parameter_name)
+
+
+@metrics.timed("ssm.put_secret")
+def put_secret(parameter_name, new_value):
     # Update the parameter
-    ssm.put_parameter(
+    ssm_client.get().put_parameter(
         Name=parameter_name,
         Value=new_value,
         Type='SecureString',  # or 'StringList' or 'SecureString'
         Overwrite=True  # Set to True to update an existing parameter
-    )
\ No newline at end of file
+    )
+
+    secrets.put(parameter_name, new_value)
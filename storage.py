@@ -0,0 +1,60 @@
+import logging
+import os
+
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+
+import metrics
+from lazy import Lazy
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+# Lambda only keeps /tmp for as long as the container stays warm, and the run function is invoked once a day, so the
+# next morning almost always starts from an empty /tmp. Files that have to last until then are copied to this bucket
+# and restored from it. When unset they only live in /tmp and only warm invocations find them.
+STATE_BUCKET = os.environ.get("STATE_BUCKET")
+
+s3_client = Lazy("s3_client", lambda: boto3.client("s3"))
+
+# What a failed restore or persist raises: service errors such as SlowDown or AccessDenied, and connection or
+# credential errors. The bucket is a cache, so callers catch these and carry on without it.
+STORAGE_ERRORS = (BotoCoreError, ClientError)
+
+
+def write_atomically(path: str, data: bytes):
+    # Readers and a crash mid-write both see either the old file or the new one, never a truncated one
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(data)
+    os.replace(temporary_path, path)
+
+
+@metrics.timed("storage.restore")
+def restore(path: str, key: str):
+    # Brings back the bucket's copy when /tmp has none. Returns whether a local file is there afterwards.
+    if os.path.exists(path):
+        return True
+    if not STATE_BUCKET:
+        return False
+
+    try:
+        response = s3_client.get().get_object(Bucket=STATE_BUCKET, Key=key)
+    except ClientError as exc:
+        if exc.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return False
+        raise
+
+    write_atomically(path, response["Body"].read())
+    logger.info(f"Restored {key} from {STATE_BUCKET}")
+    return True
+
+
+@metrics.timed("storage.persist")
+def persist(path: str, key: str):
+    if not STATE_BUCKET:
+        return
+
+    with open(path, "rb") as f:
+        s3_client.get().put_object(Bucket=STATE_BUCKET, Key=key, Body=f.read())
@@ -0,0 +1,382 @@
+import concurrent.futures
+import logging
+
+import numpy as np
+
+import indicator_state
+import indicators
+from parameters import Parameters
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+# What an indicator needs fetched before it can be computed live
+PRICES = "prices"
+DIVIDENDS = "dividends"
+
+RISK_ON_OPTIONS = ["SOXL", "TQQQ", "UPRO", "TECL"]
+RISING_RATES_OPTIONS = ["QID", "TBF"]
+RISING_RATES_HEDGE = "UUP"
+FALLING_RATES_STOCKS = ["UGL", "TMF", "BTAL", "XLP"]
+
+
+# Indicators. value() computes today's number from live data, series() every day's number from a backtest universe.
+
+class Indicator:
+    kind = None
+
+    def __init__(self, symbol: str, days: int):
+        self.symbol = symbol
+        self.days = days
+
+    @property
+    def key(self):
+        return self.kind, self.symbol, self.days
+
+    def __repr__(self):
+        return f"{self.days} day {self.kind} of {self.symbol}"
+
+
+class CumulativeReturn(Indicator):
+    kind = "return"
+
+    @property
+    def warmup(self):
+        return self.days
+
+    def requirements(self):
+        return {(PRICES, self.symbol), (DIVIDENDS, self.symbol)}
+
+    def value(self, context):
+        return context.cumulative_return(self.symbol, self.days)
+
+    def series(self, universe):
+        return universe.cumulative_return(self.symbol, self.days)
+
+
+class RelativeStrengthIndex(Indicator):
+    kind = "rsi"
+
+    @property
+    def warmup(self):
+        return self.days + 1
+
+    def requirements(self):
+        return {(PRICES, self.symbol)}
+
+    def value(self, context):
+        return context.relative_strength_index(self.symbol, self.days)
+
+    def series(self, universe):
+        return universe.relative_strength_index(self.symbol, self.days)
+
+
+# Conditions
+
+class Comparison:
+    def __init__(self, left: Indicator, right: Indicator):
+        self.left = left
+        self.right = right
+
+    def indicators(self):
+        return [self.left, self.right]
+
+    def requirements(self):
+        return self.left.requirements() | self.right.requirements()
+
+
+class GreaterThan(Comparison):
+    def test(self, context):
+        return self.left.value(context) > self.right.value(context)
+
+    def mask(self, universe):
+        return self.left.series(universe) > self.right.series(universe)
+
+    def __repr__(self):
+        return f"{self.left} > {self.right}"
+
+
+class LessThan(Comparison):
+    def test(self, context):
+        return self.left.value(context) < self.right.value(context)
+
+    def mask(self, universe):
+        return self.left.series(universe) < self.right.series(universe)
+
+    def __repr__(self):
+        return f"{self.left} < {self.right}"
+
+
+# Nodes. Each one selects a list of symbols to invest in evenly. requirements() is only what the node itself reads
+# before choosing, never what the branches below it need, so nothing is fetched for a branch that isn't taken.
+
+class Node:
+    def requirements(self):
+        return set()
+
+    def indicators(self):
+        return []
+
+    def children(self):
+        return []
+
+    def select(self, context):
+        raise NotImplementedError
+
+    def picks(self, universe, active, counts):
+        # Vectorized select: adds one to counts[t, column] for every symbol picked on each active day t
+        raise NotImplementedError
+
+
+class Hold(Node):
+    def __init__(self, *symbols: str):
+        self.symbols = list(symbols)
+
+    def select(self, context):
+        return list(self.symbols)
+
+    def picks(self, universe, active, counts):
+        for symbol in self.symbols:
+            counts[active, universe.column(symbol)] += 1
+
+
+class SelectBottom(Node):
+    # The options with the lowest indicator values, ties broken by list order
+    def __init__(self, options: list[Indicator], count: int):
+        self.options = options
+        self.count = count
+
+    def requirements(self):
+        return set().union(*(option.requirements() for option in self.options))
+
+    def indicators(self):
+        return list(self.options)
+
+    def select(self, context):
+        values = sorted(((option.symbol, option.value(context)) for option in self.options), key=lambda x: x[1])
+        logger.info(f"Sorted by {', '.join(map(repr, self.options))}: {values}")
+        selected = values[:self.count]
+        logger.info(f"Selected: {selected}")
+        return [symbol for symbol, _ in selected]
+
+    def picks(self, universe, active, counts):
+        values = np.column_stack([option.series(universe) for option in self.options])
+        columns = np.array([universe.column(option.symbol) for option in self.options])
+        ranked = np.argsort(values, axis=1, kind="stable")[:, :self.count]
+        rows = np.flatnonzero(active)
+        for rank in range(ranked.shape[1]):
+            counts[rows, columns[ranked[rows, rank]]] += 1
+
+
+class Group(Node):
+    # Everything each child selects, in order
+    def __init__(self, *nodes: Node):
+        self.nodes = list(nodes)
+
+    def requirements(self):
+        return set().union(*(node.requirements() for node in self.nodes))
+
+    def children(self):
+        return list(self.nodes)
+
+    def select(self, context):
+        return [symbol for node in self.nodes for symbol in evaluate(node, context)]
+
+    def picks(self, universe, active, counts):
+        for node in self.nodes:
+            node.picks(universe, active, counts)
+
+
+class If(Node):
+    def __init__(self, condition: Comparison, then: Node, otherwise: Node):
+        self.condition = condition
+        self.then = then
+        self.otherwise = otherwise
+
+    def requirements(self):
+        return self.condition.requirements()
+
+    def indicators(self):
+        return self.condition.indicators()
+
+    def children(self):
+        return [self.then, self.otherwise]
+
+    def select(self, context):
+        return evaluate(self.then if self.condition.test(context) else self.otherwise, context)
+
+    def picks(self, universe, active, counts):
+        mask = self.condition.mask(universe)
+        self.then.picks(universe, active & mask, counts)
+        self.otherwise.picks(universe, active & ~mask, counts)
+
+
+class Branch(Node):
+    # Names a node so the run log says which way the tree went
+    def __init__(self, name: str, node: Node):
+        self.name = name
+        self.node = node
+
+    def requirements(self):
+        return self.node.requirements()
+
+    def children(self):
+        return [self.node]
+
+    def select(self, context):
+        logger.info(f"Strategy selected: {self.name}")
+        return evaluate(self.node, context)
+
+    def picks(self, universe, active, counts):
+        self.node.picks(universe, active, counts)
+
+
+class Context:
+    # Live market data for one evaluation. Each node's inputs are fetched together when the node is reached and kept
+    # for the rest of the evaluation.
+
+    def __init__(self):
+        # Imported here so backtests and sweeps can build trees without loading the broker and AWS clients
+        from dividends import get_dividends
+        from market_data import get_price_series
+
+        self._get_dividends = get_dividends
+        self._get_price_series = get_price_series
+        self.series = {}
+        self.dividends = {}
+        self.total_returns = {}
+
+    def require(self, requirements: set):
+        prices = sorted({symbol for kind, symbol in requirements if kind == PRICES} - self.series.keys())
+        dividends = sorted({symbol for kind, symbol in requirements if kind == DIVIDENDS} - self.dividends.keys())
+
+        if not prices and not dividends:
+            return
+
+        logger.info(f"Fetching prices for {prices} and dividends for {dividends}")
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1 + len(dividends)) as executor:
+            price_future = executor.submit(self._get_price_series, prices) if prices else None
+            dividend_futures = {symbol: executor.submit(self._get_dividends, symbol) for symbol in dividends}
+
+            if price_future is not None:
+                self.series.update(price_future.result())
+            for symbol, future in dividend_futures.items():
+                self.dividends[symbol] = future.result()
+
+    def cumulative_return(self, symbol: str, days: int):
+        series = self.series[symbol]
+
+        logger.info(f"Starting date {series.dates[-1]} ending date {series.dates[0]}")
+
+        cumulative_return = self.total_return(symbol).cumulative_return(days)
+
+        if indicator_state.VERIFY:
+            indicator_state.check_agreement(symbol, "cumulative return", cumulative_return,
+                                            indicators.cumulative_return(series, self.dividends[symbol], days))
+
+        logger.info(f"Cumulative return for {symbol}: {cumulative_return}")
+
+        return cumulative_return
+
+    def total_return(self, symbol: str):
+        # Built once per ticker, every return window on it is then a single division
+        if symbol not in self.total_returns:
+            self.total_returns[symbol] = indicators.TotalReturnSeries(self.series[symbol], self.dividends[symbol])
+        return self.total_returns[symbol]
+
+    def relative_strength_index(self, symbol: str, days: int):
+        return indicator_state.store.relative_strength_index(self.series[symbol], days)
+
+
+class Snapshot(Context):
+    # A Context shared by every strategy in a run. Only the roots' inputs are fetched up front, each tree fetches the
+    # branches it actually takes as it is evaluated, and a symbol or indicator reached by several trees is fetched or
+    # computed once.
+
+    def __init__(self):
+        super().__init__()
+        self.values = {}
+
+    @classmethod
+    def build(cls, nodes: list[Node]):
+        snapshot = cls()
+        snapshot.require(set().union(*(node.requirements() for node in nodes)))
+        return snapshot
+
+    def cumulative_return(self, symbol: str, days: int):
+        return self._memoized((CumulativeReturn.kind, symbol, days), super().cumulative_return)
+
+    def relative_strength_index(self, symbol: str, days: int):
+        return self._memoized((RelativeStrengthIndex.kind, symbol, days), super().relative_strength_index)
+
+    def _memoized(self, key, compute):
+        if key not in self.values:
+            self.values[key] = compute(*key[1:])
+        return self.values[key]
+
+
+def evaluate(node: Node, context: Context):
+    context.require(node.requirements())
+    return node.select(context)
+
+
+def walk(node: Node):
+    yield node
+    for child in node.children():
+        yield from walk(child)
+
+
+def all_indicators(node: Node):
+    # Every indicator on every branch, each once
+    found = {}
+    for descendant in walk(node):
+        for indicator in descendant.indicators():
+            found.setdefault(indicator.key, indicator)
+    return list(found.values())
+
+
+def warmup(node: Node):
+    # Bars of history needed before every indicator in the tree is defined
+    return max((indicator.warmup for indicator in all_indicators(node)), default=0)
+
+
+def target_weights(node: Node, universe):
+    # The tree for every day of a backtest universe at once, row t holds the weights chosen from bars up to t
+    counts = np.zeros((len(universe.dates), len(universe.symbols)))
+    node.picks(universe, np.ones(len(universe.dates), dtype=bool), counts)
+
+    held = counts.sum(axis=1, keepdims=True)
+    weights = np.divide(counts, held, out=np.zeros_like(counts), where=held > 0)
+
+    # Nothing is known until every lookback has enough history
+    weights[:warmup(node)] = 0
+
+    return weights
+
+
+def default_strategy(parameters: Parameters = Parameters()):
+    return If(
+        GreaterThan(CumulativeReturn("AGG", parameters.risk_on_return_days),
+                    CumulativeReturn("BIL", parameters.risk_on_return_days)),
+        Branch("risk on",
+               SelectBottom([RelativeStrengthIndex(symbol, parameters.risk_on_rsi_days)
+                             for symbol in RISK_ON_OPTIONS], parameters.risk_on_picks)),
+        If(
+            LessThan(CumulativeReturn("TLT", parameters.rates_return_days),
+                     CumulativeReturn("BIL", parameters.rates_return_days)),
+            Branch("risk off, rising rates",
+                   Group(Hold(RISING_RATES_HEDGE),
+                         SelectBottom([RelativeStrengthIndex(symbol, parameters.rising_rates_rsi_days)
+                                       for symbol in RISING_RATES_OPTIONS], 1))),
+            Branch("risk off, falling rates", Hold(*FALLING_RATES_STOCKS)),
+        ),
+    )
+
+
+# Strategies a portfolio can name in its "strategy" attribute, each builds its tree from the run's parameters
+DEFAULT_STRATEGY = "default"
+
+STRATEGIES = {
+    DEFAULT_STRATEGY: default_strategy,
+}
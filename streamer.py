@@ -0,0 +1,225 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import websockets
+
+from money import Money
+from quotes import Quote
+from schwab import get_access_token, get_user_preference
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+# Quotes are pushed over the streamer websocket during the run instead of requested, off unless set
+STREAM_QUOTES = os.environ.get("STREAM_QUOTES", "0") == "1"
+
+# Seconds the run waits for the first login before going ahead on requested quotes
+CONNECT_TIMEOUT = float(os.environ.get("STREAMER_CONNECT_TIMEOUT", "5"))
+
+# Level 1 equity fields: symbol, bid, ask, last
+LEVEL_ONE_FIELDS = {"1": "bid", "2": "ask", "3": "last"}
+LEVEL_ONE_EQUITIES = "LEVELONE_EQUITIES"
+
+# Seconds to wait between reconnects, doubled after each failure up to the maximum
+RECONNECT_BACKOFF = float(os.environ.get("STREAMER_RECONNECT_BACKOFF", "0.5"))
+RECONNECT_BACKOFF_MAX = float(os.environ.get("STREAMER_RECONNECT_BACKOFF_MAX", "30"))
+
+# Consecutive failed connections before the streamer gives up and the REST quotes take over for good
+MAX_CONNECT_ATTEMPTS = int(os.environ.get("STREAMER_MAX_CONNECT_ATTEMPTS", "10"))
+
+# Seconds to wait for the login and subscription responses
+RESPONSE_TIMEOUT = float(os.environ.get("STREAMER_RESPONSE_TIMEOUT", "10"))
+
+
+class StreamerError(Exception):
+    pass
+
+
+class QuoteStreamer:
+    # Keeps the latest Level 1 quote of every subscribed symbol from the Schwab streamer websocket. The socket runs
+    # on its own thread with its own event loop, the portfolio threads only read the quote table. Quotes are only
+    # served while connected, during a reconnect callers fall back to requesting them.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._symbols = set()
+        # symbol -> the fields pushed so far, updates only carry the fields that changed
+        self._fields = {}
+        self._quotes = {}
+        self._connected = threading.Event()
+        self._stopping = threading.Event()
+        self._request_ids = itertools.count()
+        self._loop = None
+        self._websocket = None
+        self._streamer_info = None
+        self._thread = None
+
+    @property
+    def connected(self):
+        return self._connected.is_set()
+
+    def start(self, symbols):
+        self._symbols.update(symbols)
+        self._thread = threading.Thread(target=self._run_thread, name="quote-streamer", daemon=True)
+        self._thread.start()
+        return self
+
+    def wait_connected(self, timeout: float = None):
+        return self._connected.wait(timeout)
+
+    def subscribe(self, symbols):
+        with self._lock:
+            added = sorted(set(symbols) - self._symbols)
+            self._symbols.update(added)
+
+        # Not connected yet, the next login subscribes to everything in the set
+        if added and self._loop is not None and self.connected:
+            asyncio.run_coroutine_threadsafe(self._send_subscription(self._websocket, "ADD", added), self._loop)
+
+    def quote(self, symbol: str):
+        if not self.connected:
+            return None
+        with self._lock:
+            return self._quotes.get(symbol)
+
+    def stop(self):
+        self._stopping.set()
+        self._connected.clear()
+        if self._loop is not None and self._websocket is not None:
+            asyncio.run_coroutine_threadsafe(self._websocket.close(), self._loop)
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run_thread(self):
+        try:
+            asyncio.run(self._run())
+        except Exception as exc:
+            logger.error(f"Quote streamer stopped: {exc}")
+
+    async def _run(self):
+        self._loop = asyncio.get_running_loop()
+        backoff = RECONNECT_BACKOFF
+        failures = 0
+
+        while not self._stopping.is_set():
+            try:
+                await self._connect_and_stream()
+                # Closed after a successful login, start the backoff over
+                failures = 0
+                backoff = RECONNECT_BACKOFF
+            except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException, StreamerError) as exc:
+                failures += 1
+                logger.warning(f"Quote streamer connection failed ({failures}/{MAX_CONNECT_ATTEMPTS}): {exc}")
+                if failures >= MAX_CONNECT_ATTEMPTS:
+                    raise StreamerError(f"Gave up after {failures} failed connections") from exc
+            finally:
+                self._connected.clear()
+                self._websocket = None
+                with self._lock:
+                    # Whatever was held may have moved while disconnected, the resubscription sends it all again
+                    self._fields.clear()
+                    self._quotes.clear()
+
+            if not self._stopping.is_set():
+                await asyncio.sleep(random.uniform(backoff / 2, backoff))
+                backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX)
+
+    async def _connect_and_stream(self):
+        if self._streamer_info is None:
+            self._streamer_info = (await asyncio.to_thread(get_user_preference))["streamerInfo"][0]
+        info = self._streamer_info
+
+        async with websockets.connect(info["streamerSocketUrl"]) as websocket:
+            self._websocket = websocket
+            if self._stopping.is_set():
+                return
+
+            await self._login(websocket, info)
+
+            with self._lock:
+                symbols = sorted(self._symbols)
+            if symbols:
+                await self._send_subscription(websocket, "SUBS", symbols)
+
+            self._connected.set()
+            logger.info(f"Quote streamer subscribed to {len(symbols)} symbol(s)")
+
+            try:
+                async for message in websocket:
+                    self._handle(json.loads(message))
+            except websockets.exceptions.ConnectionClosed:
+                pass
+
+            if not self._stopping.is_set():
+                logger.warning("Quote streamer disconnected, reconnecting")
+
+    def _request(self, service, command, parameters):
+        info = self._streamer_info
+        return {
+            "service": service,
+            "requestid": str(next(self._request_ids)),
+            "command": command,
+            "SchwabClientCustomerId": info["schwabClientCustomerId"],
+            "SchwabClientCorrelId": info["schwabClientCorrelId"],
+            "parameters": parameters,
+        }
+
+    async def _login(self, websocket, info):
+        # The access token is fetched on the event loop's executor, a refresh may call Schwab and SSM
+        access_token = await asyncio.to_thread(get_access_token)
+        request = self._request("ADMIN", "LOGIN", {
+            "Authorization": access_token,
+            "SchwabClientChannel": info["schwabClientChannel"],
+            "SchwabClientFunctionId": info["schwabClientFunctionId"],
+        })
+        await websocket.send(json.dumps({"requests": [request]}))
+
+        # Quotes can't arrive before the login is answered, so anything else until then is a notification
+        deadline = time.monotonic() + RESPONSE_TIMEOUT
+        while True:
+            message = json.loads(await asyncio.wait_for(websocket.recv(), max(deadline - time.monotonic(), 0)))
+            for response in message.get("response", ()):
+                if response.get("command") == "LOGIN":
+                    content = response.get("content", {})
+                    if content.get("code") != 0:
+                        raise StreamerError(f"Streamer login failed: {content.get('msg')}")
+                    return
+
+    async def _send_subscription(self, websocket, command, symbols):
+        if websocket is None:
+            return
+        request = self._request(LEVEL_ONE_EQUITIES, command, {
+            "keys": ",".join(symbols),
+            "fields": ",".join(["0", *LEVEL_ONE_FIELDS]),
+        })
+        await websocket.send(json.dumps({"requests": [request]}))
+
+    def _handle(self, message):
+        for response in message.get("response", ()):
+            content = response.get("content", {})
+            if content.get("code", 0) != 0:
+                logger.error(f"Streamer {response.get('command')} failed: {content.get('msg')}")
+
+        received_at = time.monotonic()
+        for data in message.get("data", ()):
+            if data.get("service") != LEVEL_ONE_EQUITIES:
+                continue
+
+            with self._lock:
+                for update in data.get("content", ()):
+                    symbol = update["key"]
+                    fields = self._fields.setdefault(symbol, {})
+                    for number, name in LEVEL_ONE_FIELDS.items():
+                        if number in update:
+                            fields[name] = Money.of(update[number])
+
+                    # Served once all three prices have arrived
+                    if len(fields) == len(LEVEL_ONE_FIELDS):
+                        self._quotes[symbol] = Quote(symbol, fields["ask"], fields["bid"], fields["last"], True,
+                                                     received_at)
@@ -0,0 +1,195 @@
+import argparse
+import concurrent.futures
+import csv
+import itertools
+import logging
+import os
+import random
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from backtest import build_universe, load_universe, run_backtest
+from parameters import Parameters
+from strategy import all_indicators, default_strategy
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+# Parameter sets sent to a worker per task, large enough that pickling overhead disappears
+CHUNK_SIZE = 64
+
+METRICS = ["sharpe_ratio", "annualized_return", "total_return", "max_drawdown", "average_daily_turnover",
+           "stops_triggered"]
+
+
+class SharedUniverse:
+    # Same interface run_backtest uses on backtest.Universe, but every array lives in shared memory and the indicators
+    # are looked up from tables computed once in the parent instead of being recomputed per parameter set
+
+    def __init__(self, dates, symbols, arrays, indicator_index):
+        self.dates = dates
+        self.symbols = symbols
+        self.open = arrays["open"]
+        self.high = arrays["high"]
+        self.low = arrays["low"]
+        self.close = arrays["close"]
+        self.dividends = arrays["dividends"]
+        self._indicators = arrays["indicators"]
+        self._indicator_index = indicator_index
+
+    def column(self, symbol):
+        return self.symbols.index(symbol)
+
+    def cumulative_return(self, symbol, days):
+        return self._indicators[self._indicator_index[("return", symbol, days)]]
+
+    def relative_strength_index(self, symbol, days):
+        return self._indicators[self._indicator_index[("rsi", symbol, days)]]
+
+
+def _indicator_tables(universe, parameter_sets):
+    # Every (indicator, symbol, lookback) any parameter set needs, computed once
+    needed = {}
+    for parameters in parameter_sets:
+        for indicator in all_indicators(default_strategy(parameters)):
+            needed.setdefault(indicator.key, indicator)
+
+    keys = sorted(needed)
+    table = np.empty((len(keys), len(universe.dates)))
+    for row, key in enumerate(keys):
+        table[row] = needed[key].series(universe)
+
+    return table, {key: row for row, key in enumerate(keys)}
+
+
+def _share(array, blocks):
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    blocks.append(block)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block.name, array.shape, array.dtype.str
+
+
+_worker_universe = None
+_worker_blocks = []
+
+
+def _attach(dates, symbols, layout, indicator_index):
+    # Runs once per worker process, the arrays are mapped read-only rather than copied
+    global _worker_universe
+
+    arrays = {}
+    for name, (block_name, shape, dtype) in layout.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _worker_blocks.append(block)
+        array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        array.setflags(write=False)
+        arrays[name] = array
+
+    _worker_universe = SharedUniverse(dates, symbols, arrays, indicator_index)
+
+
+def _evaluate(chunk):
+    results = []
+    for parameters, transaction_cost in chunk:
+        summary = run_backtest(_worker_universe, parameters, transaction_cost).summary()
+        results.append((parameters, summary))
+    return results
+
+
+def grid(space: dict[str, list]):
+    fields = list(space)
+    for values in itertools.product(*(space[field] for field in fields)):
+        yield Parameters()._replace(**dict(zip(fields, values)))
+
+
+def random_search(space: dict[str, list], samples: int, seed: int = None):
+    generator = random.Random(seed)
+    for _ in range(samples):
+        yield Parameters()._replace(**{field: generator.choice(values) for field, values in space.items()})
+
+
+def run_sweep(universe, parameter_sets, transaction_cost: float = 0.0, workers: int = None, metric: str = "sharpe_ratio"):
+    parameter_sets = list(dict.fromkeys(parameter_sets))
+
+    table, indicator_index = _indicator_tables(universe, parameter_sets)
+
+    blocks = []
+    try:
+        layout = {
+            "open": _share(universe.open, blocks),
+            "high": _share(universe.high, blocks),
+            "low": _share(universe.low, blocks),
+            "close": _share(universe.close, blocks),
+            "dividends": _share(universe.dividends, blocks),
+            "indicators": _share(table, blocks),
+        }
+
+        tasks = [(parameters, transaction_cost) for parameters in parameter_sets]
+        chunks = [tasks[i:i + CHUNK_SIZE] for i in range(0, len(tasks), CHUNK_SIZE)]
+
+        results = []
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers or os.cpu_count(),
+                initializer=_attach,
+                initargs=(universe.dates, universe.symbols, layout, indicator_index)) as executor:
+            for chunk_results in executor.map(_evaluate, chunks):
+                results.extend(chunk_results)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    # Drawdown is negative, so larger is better for every metric except turnover
+    results.sort(key=lambda result: result[1][metric], reverse=metric != "average_daily_turnover")
+
+    return results
+
+
+def write_results(path: str, results):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["rank"] + list(Parameters._fields) + METRICS)
+        for rank, (parameters, summary) in enumerate(results, start=1):
+            writer.writerow([rank] + list(parameters) + [summary[metric] for metric in METRICS])
+
+
+def _parse_values(field, text):
+    cast = type(Parameters._field_defaults[field])
+    if ":" in text:
+        # start:stop:step, stop inclusive
+        start, stop, step = (cast(part) for part in text.split(":"))
+        return [cast(value) for value in np.arange(start, stop + step / 2, step)]
+    return [cast(value) for value in text.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep strategy parameters over a backtest universe")
+    parser.add_argument("data", help="universe file written by backtest.py --fetch")
+    parser.add_argument("--output", default="sweep_results.csv")
+    parser.add_argument("--metric", default="sharpe_ratio", choices=METRICS)
+    parser.add_argument("--samples", type=int, help="draw this many random combinations instead of the full grid")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--transaction-cost", type=float, default=0.0)
+    for field in Parameters._fields:
+        parser.add_argument(f"--{field.replace('_', '-')}", metavar="VALUES",
+                            help="comma separated values or start:stop:step")
+    args = parser.parse_args()
+
+    space = {field: _parse_values(field, getattr(args, field)) for field in Parameters._fields
+             if getattr(args, field) is not None}
+
+    parameter_sets = random_search(space, args.samples, args.seed) if args.samples else grid(space)
+
+    universe = build_universe(*load_universe(args.data))
+    results = run_sweep(universe, parameter_sets, args.transaction_cost, args.workers, args.metric)
+
+    write_results(args.output, results)
+
+    for parameters, summary in results[:10]:
+        print(f"{summary[args.metric]:.4f} {parameters}")
+
+
+if __name__ == "__main__":
+    main()